@@ -0,0 +1,273 @@
+#!/bin/env python3
+# Benchmark suite for the fwsim matching engines.
+#
+# Generates seeded synthetic policies and Zipf distributed packet traces,
+# runs every requested engine on them in a fresh process and reports
+# startup time, packets per second and peak RSS as JSON. Results can be
+# stored as a baseline and later runs compared against it, so regressions
+# can fail a build.
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import fwsim
+
+WELL_KNOWN_PORTS = [20, 21, 22, 23, 25, 53, 80, 110, 123, 143, 443, 993, 3306, 8080]
+
+# largest share of shadowed rules a generated policy may have, past that
+# a run would measure far fewer rules than it claims
+MAX_SHADOWED = 0.1
+
+DEFAULT_ENGINES = ['linear', 'trie', 'interval']
+# linear does about 1k packets/s at 10k rules, so without --engines it only
+# runs on policies up to this size
+LINEAR_MAX_RULES = 1000
+
+
+def random_port(rng):
+    if rng.random() < 0.7:
+        return rng.choice(WELL_KNOWN_PORTS)
+    return rng.randint(1, 65535)
+
+
+def generate_rules(n, seed, wildcard=0.25, any_address=0.0, catch_all=False):
+    '''
+    Random policy of n rule lines: mostly /16 to /32 networks with some
+    short prefixes and '*', single ports, port lists and ranges, and about
+    a fifth established rules. wildcard is the share of '*' port fields,
+    any_address the share of rules with '*' for the address on top of that.
+
+    Networks shorter than /16 and '*' only get a single port above 1023,
+    so the policy doesn't end up mostly shadowed (no '* *' catch-all in
+    the middle, for one). With catch_all the last rule of each direction
+    is a '* *' drop, counted in n.
+    '''
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(n - len(fwsim.DIRECTIONS) if catch_all else n):
+        prefix = rng.choices([0, 8, 12, 16, 20, 24, 28, 32],
+                             [2, 3, 5, 15, 10, 40, 5, 20])[0]
+        if rng.random() < any_address:
+            prefix = 0
+        if prefix == 0:
+            cidr = "*"
+        else:
+            ip = rng.getrandbits(32) & (0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF
+            cidr = f"{fwsim.int2ip(ip)}/{prefix}"
+
+        kind = rng.random()
+        if kind < wildcard:
+            ports = "*"
+        elif kind < wildcard + (1 - wildcard) * 0.55:
+            ports = str(random_port(rng))
+        elif kind < wildcard + (1 - wildcard) * 0.8:
+            ports = ",".join(str(random_port(rng)) for _ in range(rng.randint(2, 5)))
+        else:
+            low = rng.randint(1, 60000)
+            ports = f"{low}-{low + rng.randint(1, 5000)}"
+        if prefix < 16:
+            # one unusual port, or the short prefix would shadow most rules inside it
+            ports = str(rng.randint(1024, 65535))
+
+        line = (f"{rng.choice(fwsim.DIRECTIONS)} {rng.choice(['accept', 'drop', 'deny'])} "
+                f"{cidr} {ports}")
+        if rng.random() < 0.2:
+            line += " established"
+        lines.append(line)
+    if catch_all:
+        lines.extend(f"{direction} drop * *" for direction in fwsim.DIRECTIONS)
+    return lines
+
+
+def generate_packets(rules, n, seed, flows=10000, skew=1.1):
+    '''
+    n packet lines drawn from a fixed set of flows with Zipf distributed
+    popularity (exponent skew). Most flows are aimed at some rule's network
+    and port so the policy actually gets exercised.
+    '''
+    rng = random.Random(seed)
+    pool = []
+    for _ in range(flows):
+        rule = rng.choice(rules)
+        if rng.random() < 0.8:
+            ip = rule.net | (rng.getrandbits(32) & ~rule.mask & 0xFFFFFFFF)
+            ranges = fwsim.port_ranges(rule.ports) if rule.ports is not None else None
+            port = rng.randint(*rng.choice(ranges)) if ranges else random_port(rng)
+        else:
+            ip = rng.getrandbits(32)
+            port = random_port(rng)
+        pool.append(f"{rule.direction} {fwsim.int2ip(ip)} {port} {rng.randint(0, 1)}\n")
+
+    weights = [1 / (k + 1) ** skew for k in range(flows)]
+    for start in range(0, n, 100000):
+        yield from rng.choices(pool, weights, k=min(100000, n - start))
+
+
+def write_workload(workdir, n_rules, n_packets, seed, flows, wildcard, any_address=0.0,
+                   catch_all=False):
+    '''
+    writes rules and packets files into workdir, returns their names; exits
+    if more than MAX_SHADOWED of the rules are shadowed
+    '''
+    rules_fname = os.path.join(workdir, f"rules_{n_rules}_{seed}.txt")
+    packets_fname = os.path.join(workdir, f"packets_{n_rules}_{n_packets}_{seed}.txt")
+    lines = generate_rules(n_rules, seed, wildcard, any_address, catch_all)
+    with open(rules_fname, "w") as fp:
+        fp.write("\n".join(lines) + "\n")
+    rules = [fwsim.get_rules(line, i, rules_fname) for i, line in enumerate(lines, 1)]
+    shadowed = sum(found["status"] == "shadowed" for found in fwsim.analyze_rules(rules).values())
+    if shadowed > MAX_SHADOWED * len(rules):
+        sys.exit(f"generated policy of {len(rules)} rules has {shadowed} shadowed ones, "
+                 f"lower --any-address or --wildcard")
+    with open(packets_fname, "w") as fp:
+        fp.writelines(generate_packets(rules, n_packets, seed + 1, flows))
+    return rules_fname, packets_fname
+
+
+def run_engine(engine, rules_fname, packets_fname) -> dict:
+    '''measures one engine in this process'''
+    start = time.perf_counter()
+    matcher = fwsim.compile_rules(rules_fname, engine, rules_cache=False)
+    startup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    columns = fwsim.load_packets(packets_fname)
+    parse = time.perf_counter() - start
+
+    # engine speed only, the decision cache would hide the differences
+    start = time.perf_counter()
+    decided = fwsim.decide_columns(matcher, columns, fwsim.DecisionCache(0))
+    classify = time.perf_counter() - start
+
+    return {
+        "engine": engine,
+        "startup_s": round(startup, 4),
+        "parse_s": round(parse, 4),
+        "classify_s": round(classify, 4),
+        "packets_per_s": round(len(columns) / classify) if classify else None,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "defaults": sum(rule is None for rule in decided),
+    }
+
+
+def run_isolated(engine, rules_fname, packets_fname) -> dict:
+    '''runs one engine in a fresh interpreter so peak RSS is its own'''
+    out = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker", engine,
+         rules_fname, packets_fname],
+        check=True, capture_output=True, text=True).stdout
+    return json.loads(out)
+
+
+def regressions(results, baseline, tolerance) -> list[str]:
+    '''compares results against a stored baseline, returns what got worse'''
+    old = {(r["rules"], r["engine"]): r for r in baseline["results"]}
+    found = []
+    for r in results:
+        b = old.get((r["rules"], r["engine"]))
+        if b is None:
+            continue
+        name = f"{r['engine']} with {r['rules']} rules"
+        if r["packets_per_s"] < b["packets_per_s"] * (1 - tolerance):
+            found.append(f"{name}: {r['packets_per_s']} packets/s, baseline {b['packets_per_s']}")
+        if r["startup_s"] > b["startup_s"] * (1 + tolerance) + 0.01:
+            found.append(f"{name}: startup {r['startup_s']}s, baseline {b['startup_s']}s")
+    return found
+
+
+def parse_args():
+    '''parse command lines'''
+    parser = argparse.ArgumentParser(
+        prog='bench',
+        description='benchmark fwsim engines on synthetic policies and traces',
+    )
+    parser.add_argument('--rules', type=int, nargs='+', default=[10, 1000, 10000],
+                        help='policy sizes to run (default: 10 1000 10000)')
+    parser.add_argument('--packets', type=int, default=100000, help='packets per trace')
+    parser.add_argument('--flows', type=int, default=10000, help='distinct flows per trace')
+    parser.add_argument('--wildcard', type=float, default=0.25,
+                        help="share of rules with '*' ports (default: 0.25)")
+    parser.add_argument('--any-address', type=float, default=0.0,
+                        help="share of rules with '*' addresses on top of the usual few "
+                             "(default: 0)")
+    parser.add_argument('--catch-all', action='store_true',
+                        help="end the policy with a '* *' drop rule per direction")
+    parser.add_argument('--seed', type=int, default=526)
+    parser.add_argument('--engines', nargs='+', choices=list(fwsim.ENGINES),
+                        help=f'engines to run (default: {" ".join(DEFAULT_ENGINES)}, '
+                             f'linear only up to {LINEAR_MAX_RULES} rules)')
+    parser.add_argument('--workdir', help='where to keep generated files (default: temporary)')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--baseline', help='JSON report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against the baseline (default: 0.2)')
+    parser.add_argument('--worker', nargs=3, metavar=('ENGINE', 'RULES', 'PACKETS'),
+                        help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    '''entry point'''
+    args = parse_args()
+    if args.worker:
+        print(json.dumps(run_engine(*args.worker)))
+        return
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = args.workdir or tmpdir
+        results = []
+        for n_rules in args.rules:
+            rules_fname, packets_fname = write_workload(
+                workdir, n_rules, args.packets, args.seed, args.flows, args.wildcard,
+                args.any_address, args.catch_all)
+            engines = args.engines or [
+                engine for engine in DEFAULT_ENGINES
+                if engine != 'linear' or n_rules <= LINEAR_MAX_RULES]
+            reference = None
+            for engine in engines:
+                result = run_isolated(engine, rules_fname, packets_fname)
+                result["rules"] = n_rules
+                if reference is None:
+                    reference = result["defaults"]
+                elif result["defaults"] != reference:
+                    print(f"{engine}: default count differs with {n_rules} rules",
+                          file=sys.stderr)
+                results.append(result)
+                print(f"{n_rules:>7} rules {engine:15} {result['packets_per_s']:>10} packets/s"
+                      f" startup {result['startup_s']:.3f}s", file=sys.stderr)
+
+    report = {
+        "packets": args.packets,
+        "flows": args.flows,
+        "wildcard": args.wildcard,
+        "any_address": args.any_address,
+        "catch_all": args.catch_all,
+        "seed": args.seed,
+        "python": sys.version.split()[0],
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            found = regressions(results, json.load(fp), args.tolerance)
+        for line in found:
+            print(f"regression: {line}", file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
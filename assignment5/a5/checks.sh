@@ -0,0 +1,412 @@
+#!/bin/bash
+# Randomized and end-to-end checks for what the sample files don't cover.
+# Every check builds seeded random policies and packets (IPv4 and IPv6)
+# in a scratch directory and compares against a brute-force answer, and
+# prints "ok" or what went wrong. Exits with status 1 if any check fails.
+# ./checks.sh NAME... runs only the named checks.
+cd "$(dirname "$0")"
+here=$(pwd)
+scratch=$(mktemp -d)
+trap 'rm -rf "$scratch"' EXIT
+status=0
+
+# random policies and packets, shared by the checks below
+gen='
+import random, fwsim
+
+V4_BASES = [0x0A000000, 0x0A010000, 0xC0A80000]
+V6_BASES = [0x20010DB8 << 96, 0x20010DB9 << 96]
+PORTS = ["*", "*", "22", "80", "443", "22,80,443", "1000-2000", "8000-8080,443"]
+
+
+def random_rule(rng, v6):
+    if rng.random() < 0.05:
+        net = "*"
+    elif rng.random() < v6:
+        ip = rng.choice(V6_BASES) | (rng.getrandbits(16) << rng.choice([0, 64, 80]))
+        net = f"{fwsim.int2ip6(ip)}/{rng.choice([0, 32, 48, 64, 80, 96, 112, 128])}"
+    else:
+        ip = rng.choice(V4_BASES) | rng.getrandbits(16)
+        net = f"{fwsim.int2ip(ip)}/{rng.choice([0, 8, 16, 20, 24, 28, 32])}"
+    action = rng.choice(["accept", "drop", "deny"])
+    line = f"{rng.choice(fwsim.DIRECTIONS)} {action} {net} {rng.choice(PORTS)}"
+    return line + (" established" if rng.random() < 0.2 else "")
+
+
+def random_packet(rng, rules):
+    rule = rng.choice(rules)
+    if rule.family == 6:
+        host = rng.getrandbits(128) if rng.random() < 0.3 else rng.getrandbits(8)
+        ip = fwsim.int2ip6(rule.net | (host & ~rule.mask & fwsim.V6_MASK))
+    else:
+        host = rng.getrandbits(32) if rng.random() < 0.3 else rng.getrandbits(8)
+        ip = fwsim.int2ip(rule.net | (host & ~rule.mask & 0xFFFFFFFF))
+    port = rng.choice([22, 80, 443, 1500, 8000, 8080, 9, 65535])
+    return f"{rng.choice(fwsim.DIRECTIONS)} {ip} {port} {rng.randint(0, 1)}"
+
+
+def write_workload(seed, n_rules=200, n_packets=3000, v6=0.3, name="w"):
+    """writes name_rules.txt and name_packets.txt, returns the file names and rules"""
+    rng = random.Random(seed)
+    rules_fname, packets_fname = f"{name}_rules.txt", f"{name}_packets.txt"
+    with open(rules_fname, "w") as fp:
+        fp.writelines(random_rule(rng, v6) + "\n" for _ in range(n_rules))
+    rules = fwsim.read_rules(rules_fname)
+    with open(packets_fname, "w") as fp:
+        fp.writelines(random_packet(rng, rules) + "\n" for _ in range(n_packets))
+    return rules_fname, packets_fname, rules
+
+
+def reference(rules, packet):
+    """first matching rule by the rule_packet_comp() scan, or None"""
+    for rule in rules:
+        if fwsim.rule_packet_comp(rule.fields, packet):
+            return rule
+    return None
+'
+
+selected() {
+    [ ${#names[@]} = 0 ] || [[ " ${names[*]} " == *" $1 "* ]]
+}
+
+# check NAME: runs the python on stdin in the scratch directory
+check() {
+    local code out
+    code=$(cat)
+    selected "$1" || return 0
+    if out=$(cd "$scratch" && PYTHONPATH="$here" python3 -c "$gen$code" 2>&1); then
+        echo "ok      $1"
+    else
+        echo "FAILED  $1"
+        echo "$out" | tail -5 | sed 's/^/        /'
+        status=1
+    fi
+}
+
+names=("$@")
+
+# PolicyDiff regions against lookups of the old and new rules, packet by packet
+check diff <<'EOF'
+for seed in range(6):
+    _, packets_fname, old = write_workload(seed, name="old")
+    new = fwsim.read_rules(write_workload(seed + 100, name="new")[0])
+    if seed % 2:
+        # a change of the old rules rather than a different policy
+        new = old[:len(old) // 2] + new[:20] + old[len(old) // 2:]
+    for actions_only in (False, True):
+        diff = fwsim.PolicyDiff(old, new, actions_only)
+        columns = fwsim.load_packets(packets_fname)
+        inside = 0
+        for k in range(len(columns)):
+            packet = columns.packet(k)
+            ip_int, port, established = fwsim.ip2int(packet[1]), int(packet[2]), packet[3] == "1"
+            o, n = reference(old, packet), reference(new, packet)
+            region = diff.region_of(packet[0], ip_int, port, established)
+            assert (region is not None) == diff._differ(o, n), (seed, packet)
+            if region is not None:
+                inside += 1
+                direction, est, ip_low, ip_high, port_low, port_high, ro, rn = diff.regions[region]
+                assert (ro, rn) == (o, n) and direction == packet[0] and est == established
+                assert ip_low <= ip_int <= ip_high and port_low <= port <= port_high
+        assert sum(diff.count(packets_fname)) == inside and diff.total == len(columns)
+EOF
+
+# FlowTable(verify=True) counts exactly the answers that differ from a stateless run
+check flows <<'EOF'
+rng = random.Random(17)
+_, _, rules = write_workload(17, name="flows")
+pool = [random_packet(rng, rules).rsplit(" ", 1)[0] for _ in range(300)]
+with open("flows_packets.txt", "w") as fp:
+    fp.writelines(f"{rng.choice(pool)} {rng.randint(0, 1)}\n" for _ in range(6000))
+# established rules in front of some flows, which the flow table answers with
+# the rule that accepted the flow instead
+lines = []
+for flow in rng.sample(pool, 30):
+    direction, ip, port = flow.split()
+    lines.append(f"{direction} deny {ip}/{128 if ':' in ip else 32} {port} established")
+lines += [" ".join(rule.fields) for rule in rules] + ["in accept * *", "out accept * *"]
+rules_fname = "flows_rules.txt"
+with open(rules_fname, "w") as fp:
+    fp.writelines(line + "\n" for line in lines)
+with open("stateless_rules.txt", "w") as fp:
+    fp.writelines(line.replace(" established", "") + "\n" for line in lines)
+differing = 0
+for fname in (rules_fname, "stateless_rules.txt"):
+    for engine in ("trie", "vectorized", "linear"):
+        for bulk in (False, True):
+            flows = fwsim.FlowTable(size=50, idle=400, verify=True)
+            tracked = list(fwsim.fwsim_iter(fname, "flows_packets.txt", engine=engine,
+                                            rules_cache=False, bulk=bulk, flows=flows))
+            plain = list(fwsim.fwsim_iter(fname, "flows_packets.txt", engine=engine,
+                                          rules_cache=False, bulk=bulk))
+            differ = sum(a != b for a, b in zip(tracked, plain))
+            assert len(tracked) == len(plain) == 6000, (engine, bulk)
+            assert flows.mismatches == differ, (fname, engine, bulk, flows.mismatches, differ)
+            assert flows.hits and flows.evictions, (engine, bulk)
+            if fname == rules_fname:
+                differing += differ
+            else:
+                # without established rules a flow only ever gets its own rule
+                assert differ == 0, (engine, bulk)
+assert differing, "no packet where the flow table differs, the check proves nothing"
+EOF
+
+# every engine, optimized or not, text, bulk and deduplicated, on mixed IPv4/IPv6
+check engines <<'EOF'
+for seed in range(3):
+    rules_fname, packets_fname, rules = write_workload(seed + 25, name="engines")
+    expected = [reference(rules, packet) for packet in fwsim.read_packets(packets_fname)]
+    for engine in fwsim.ENGINES:
+        for optimize in (False, True, "redundant"):
+            for bulk, dedup in ((False, None), (True, None), (True, fwsim.FlowDedup())):
+                results = list(fwsim.fwsim_iter(rules_fname, packets_fname, engine=engine,
+                                                rules_cache=False, optimize=optimize,
+                                                bulk=bulk, dedup=dedup))
+                assert len(results) == len(expected), (engine, optimize, bulk)
+                for result, rule in zip(results, expected):
+                    # redundant rules go, so only the action has to stay
+                    want = (rule.action, str(rule.line)) if rule else ("default", "")
+                    got = result[:2]
+                    if optimize == "redundant":
+                        want, got = want[0], got[0]
+                    assert got == want, (seed, engine, optimize, bulk, dedup, result, want)
+EOF
+
+# fwsimd answers like fw.py, over stdin and its socket, and follows the rules file
+check daemon <<'EOF'
+import os, socket, subprocess, sys, time
+here = os.path.dirname(os.path.abspath(fwsim.__file__))
+
+
+def fw(rules_fname, packets_fname):
+    return subprocess.run([sys.executable, os.path.join(here, "fw.py"), rules_fname,
+                           packets_fname], capture_output=True, check=True).stdout
+
+
+def ask(path, data):
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(path)
+        sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+        return b"".join(iter(lambda: sock.recv(1 << 16), b""))
+
+
+def wait_for(condition, what):
+    deadline = time.monotonic() + 20
+    while not condition():
+        assert time.monotonic() < deadline, what
+        time.sleep(0.05)
+
+
+write_workload(16, name="old")
+_, packets_fname, _ = write_workload(17, name="new")
+with open(packets_fname, "rb") as fp:
+    packets = fp.read()
+daemon = [sys.executable, os.path.join(here, "fwsimd.py"), "rules.txt"]
+os.rename("old_rules.txt", "rules.txt")
+expected = fw("rules.txt", packets_fname)
+assert expected != fw("new_rules.txt", packets_fname)
+assert subprocess.run(daemon + ["--interval", "0"], input=packets,
+                      capture_output=True, timeout=60).stdout == expected
+
+# a regular file where the socket goes is left alone
+with open("not_a_socket", "w") as fp:
+    fp.write("keep")
+out = subprocess.run(daemon + ["--socket", "not_a_socket"], capture_output=True,
+                     timeout=20).stdout
+assert out.startswith(b"Simulator error:") and open("not_a_socket").read() == "keep", out
+
+# a stale socket of an earlier run is replaced
+stale = socket.socket(socket.AF_UNIX)
+stale.bind("fwsimd.sock")
+stale.close()
+proc = subprocess.Popen(daemon + ["--socket", "fwsimd.sock", "--interval", "0.05"],
+                        stderr=subprocess.PIPE)
+try:
+    def answers(expected):
+        try:
+            return ask("fwsimd.sock", packets) == expected
+        except (ConnectionRefusedError, FileNotFoundError):
+            return False
+
+    wait_for(lambda: answers(expected), "no answer like fw.py on the socket")
+    os.replace("new_rules.txt", "rules.txt")
+    expected = fw("rules.txt", packets_fname)
+    wait_for(lambda: answers(expected), "changed rules not picked up")
+    with open("rules.txt", "a") as fp:
+        fp.write("in bogus 10.0.0.0/8 *\n")
+    time.sleep(0.5)
+    assert answers(expected), "an invalid rules file replaced the rules"
+finally:
+    proc.terminate()
+    errors = proc.communicate(timeout=10)[1].decode()
+assert "keeping the previous rules" in errors, errors
+assert not os.path.lexists("fwsimd.sock"), "socket left behind"
+EOF
+
+# the compiled rules cache is used when it can be and never gives stale answers
+check cache <<'EOF'
+import os, threading
+rules_fname, packets_fname, rules = write_workload(10, name="cache")
+packets = list(fwsim.read_packets(packets_fname))
+builds = []
+build_matcher = fwsim.build_matcher
+fwsim.build_matcher = lambda *args: builds.append(args) or build_matcher(*args)
+
+
+def compiled(fname, optimize, rules, built):
+    """compiles fname, checks whether it was built and its decisions"""
+    del builds[:]
+    matcher = fwsim.compile_rules(fname, "interval", optimize=optimize)
+    assert len(builds) == built, (fname, optimize, len(builds))
+    for packet in packets:
+        ip_int = fwsim.ip2int(packet[1])
+        rule = (matcher if ip_int <= 0xFFFFFFFF else matcher.v6).lookup(
+            packet[0], ip_int, int(packet[2]), packet[3] == "1")
+        expected = reference(rules, packet)
+        got = (rule.action, rule.line) if rule else None
+        want = (expected.action, expected.line) if expected else None
+        if optimize == "redundant":
+            got, want = got and got[0], want and want[0]
+        assert got == want, (fname, optimize, packet)
+
+
+for optimize in (False, True, "redundant"):
+    variant = "interval" + {False: "", True: ".opt", "redundant": ".redundant"}[optimize]
+    cache_fname = fwsim.rules_cache_fname(rules_fname, variant)
+    compiled(rules_fname, optimize, rules, 1)
+    assert os.path.exists(cache_fname), cache_fname
+    compiled(rules_fname, optimize, rules, 0)
+
+    # a change that keeps size and mtime is still caught by the hash
+    st = os.stat(rules_fname)
+    with open(rules_fname) as fp:
+        text = fp.read()
+    swapped = text.replace("drop", "DROP").replace("deny", "drop").replace("DROP", "deny")
+    with open(rules_fname, "w") as fp:
+        fp.write(swapped)
+    os.utime(rules_fname, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert os.stat(rules_fname).st_size == st.st_size and swapped != text
+    rules = fwsim.read_rules(rules_fname)
+    compiled(rules_fname, optimize, rules, 1)
+
+    # a corrupt or cut off cache is compiled again
+    with open(cache_fname, "r+b") as fp:
+        fp.truncate(os.path.getsize(cache_fname) // 2)
+    compiled(rules_fname, optimize, rules, 1)
+    with open(cache_fname, "r+b") as fp:
+        fp.seek(-100, os.SEEK_END)
+        fp.write(bytes(100))
+    compiled(rules_fname, optimize, rules, 1)
+    compiled(rules_fname, optimize, rules, 0)
+
+    # and so is one built by another fwsim.py
+    source_digest = fwsim.source_digest
+    fwsim.source_digest = lambda: "changed"
+    compiled(rules_fname, optimize, rules, 1)
+    fwsim.source_digest = source_digest
+
+    # rules from a pipe are read once and leave no cache behind
+    os.mkfifo("pipe_rules.txt")
+    writer = threading.Thread(target=lambda: open("pipe_rules.txt", "w").write(swapped))
+    writer.start()
+    compiled("pipe_rules.txt", optimize, rules, 1)
+    writer.join()
+    os.unlink("pipe_rules.txt")
+    assert not os.path.exists(fwsim.rules_cache_fname("pipe_rules.txt", variant))
+EOF
+
+# binary packet traces decide like the text packets they were packed from
+check traces <<'EOF'
+import os, signal, threading
+rules_fname, packets_fname, rules = write_workload(12, n_packets=5000, v6=0, name="traces")
+with open(packets_fname) as fp:
+    text = fp.read()
+expected = list(fwsim.fwsim_iter(rules_fname, packets_fname, rules_cache=False, bulk=True))
+for (action, line, *packet), packet_text in zip(expected, fwsim.read_packets(packets_fname)):
+    rule = reference(rules, packet_text)
+    assert (action, line) == ((rule.action, str(rule.line)) if rule else ("default", ""))
+assert fwsim.pack_packets(packets_fname, "trace.bin") == len(expected)
+assert fwsim.is_packet_trace("trace.bin")
+for jobs in (1, 2):
+    assert list(fwsim.fwsim_iter(rules_fname, "trace.bin", rules_cache=False,
+                                 jobs=jobs)) == expected, jobs
+    for fname in (packets_fname, "trace.bin"):
+        results = fwsim.fwsim(rules_fname, fname, columnar=True, rules_cache=False, jobs=jobs)
+        assert list(results) == expected, (fname, jobs)
+
+# cut off or corrupt traces are errors, not fewer or made up packets
+with open("trace.bin", "rb") as fp:
+    trace = fp.read()
+size = fwsim.TRACE_RECORD.size
+for broken in (trace[:-3], trace[:-size - 1], trace[:len(fwsim.TRACE_MAGIC) + size] + b"\x07"
+               + trace[len(fwsim.TRACE_MAGIC) + size + 1:]):
+    with open("broken.bin", "wb") as fp:
+        fp.write(broken)
+    try:
+        list(fwsim.fwsim_iter(rules_fname, "broken.bin", rules_cache=False))
+    except Warning:
+        pass
+    else:
+        raise AssertionError(f"broken trace of {len(broken)} bytes accepted")
+
+# packets from a pipe are read as text, in chunks that can end mid line
+def timed_out(signum, frame):
+    raise AssertionError("reading the pipe hangs")
+
+
+def piped(read):
+    os.mkfifo("pipe_packets.txt")
+    writer = threading.Thread(target=lambda: open("pipe_packets.txt", "w").write(text),
+                              daemon=True)
+    writer.start()
+    signal.signal(signal.SIGALRM, timed_out)
+    signal.alarm(60)
+    try:
+        return read("pipe_packets.txt")
+    finally:
+        signal.alarm(0)
+        writer.join(5)
+        if writer.is_alive():
+            # read() gave up before opening the pipe
+            with open("pipe_packets.txt") as fp:
+                fp.read()
+            writer.join()
+        os.unlink("pipe_packets.txt")
+
+
+for bulk in (False, True):
+    assert piped(lambda fname: list(fwsim.fwsim_iter(rules_fname, fname, rules_cache=False,
+                                                     bulk=bulk))) == expected, bulk
+chunks = piped(lambda fname: list(fwsim.iter_packet_columns(fname, chunk_size=1000)))
+assert len(chunks) > 10
+assert ([list(c.packet(k)) for c in chunks for k in range(len(c))]
+        == list(fwsim.read_packets(packets_fname)))
+assert [c.lines[0] for c in chunks] == [1 + sum(map(len, chunks[:i])) for i in range(len(chunks))]
+try:
+    piped(lambda fname: list(fwsim.fwsim_iter(rules_fname, fname, rules_cache=False, jobs=2)))
+except Warning:
+    pass
+else:
+    raise AssertionError("piped packets split over jobs")
+
+# IPv6 packets have no trace format, and a failed pack keeps the old trace
+_, packets6_fname, _ = write_workload(12, v6=0.5, name="traces6")
+try:
+    fwsim.pack_packets(packets6_fname, "trace.bin")
+except Warning:
+    assert open("trace.bin", "rb").read() == trace
+    assert not [fname for fname in os.listdir() if fname.endswith(".tmp")]
+else:
+    raise AssertionError("IPv6 packets packed into a trace")
+
+# packing a file onto itself would truncate it first
+try:
+    fwsim.pack_packets(packets_fname, packets_fname)
+except Warning:
+    assert open(packets_fname).read() == text
+else:
+    raise AssertionError("packets file packed onto itself")
+EOF
+
+exit $status
@@ -0,0 +1,45 @@
+#!/bin/bash
+# Conformance suite: every registered engine must reproduce the sample
+# results through fw.py (engine picked with FWSIM_ENGINE) and through
+# fwsim.py in text and bulk mode with every decision checked against the
+# reference matcher, and must fail on the bad rules/packets files exactly
+# like the linear engine.
+cd "$(dirname "$0")"
+
+engines=$(python3 -c "import fwsim; print(*fwsim.ENGINES)")
+expected=$(mktemp)
+trap 'rm -f "$expected"' EXIT
+status=0
+
+check() {
+    if ! "${@:2}" 2>/dev/null | cmp -s "$1" -; then
+        echo "FAILED  $engine: ${*:2}"
+        failed=1
+    fi
+}
+
+for engine in $engines; do
+    if ! python3 -c "import fwsim; fwsim.build_matcher([], '$engine')" 2>/dev/null; then
+        echo "skipped $engine: not available here"
+        continue
+    fi
+    failed=0
+    for i in 0 1 2 3; do
+        check results$i.txt env FWSIM_ENGINE=$engine python3 fw.py rules$i.txt packets$i.txt
+        check results$i.txt python3 fwsim.py --no-rules-cache --engine $engine --shadow 1 \
+            rules$i.txt packets$i.txt
+        check results$i.txt python3 fwsim.py --no-rules-cache --engine $engine --shadow 1 \
+            --bulk rules$i.txt packets$i.txt
+    done
+    for files in "badrules.txt packets0.txt" "rules0.txt badpackets.txt"; do
+        FWSIM_ENGINE=linear python3 fw.py $files > "$expected"
+        check "$expected" env FWSIM_ENGINE=$engine python3 fw.py $files
+    done
+    if [ $failed = 0 ]; then
+        echo "ok      $engine"
+    else
+        status=1
+    fi
+done
+
+exit $status
@@ -0,0 +1,72 @@
+#!/bin/env python3
+# Shows what a rules change does before it is deployed: the address and
+# port regions where the old and new rules decide differently, worked out
+# from the rules alone. A packets file or trace can be given to count how
+# much traffic lands in each region.
+
+import argparse
+import json
+import os
+import sys
+
+import fwsim
+
+
+def format_region(region) -> str:
+    '''one region as a table row'''
+    row = (f"{region['direction']:3} {int(region['established']):<3} {region['addresses']:31} "
+           f"{region['ports']:11} {region['old']:12} {region['new']:12}")
+    if "packets" in region:
+        row += f" {region['packets']}"
+    return row.rstrip()
+
+
+def parse_args():
+    '''parse command lines'''
+    parser = argparse.ArgumentParser(
+        prog='fwdiff',
+        description='list the address/port regions where two rules files decide differently',
+    )
+    parser.add_argument('oldrulesfname', help='filename with the current firewall rules')
+    parser.add_argument('newrulesfname', help='filename with the changed firewall rules')
+    parser.add_argument('--packets', metavar='FILE',
+                        help='packets file or trace to count per region')
+    parser.add_argument('--actions-only', action='store_true',
+                        help='ignore regions where only the deciding rule line changes')
+    parser.add_argument('--json', action='store_true', help='print the regions as JSON')
+    return parser.parse_args()
+
+
+def main():
+    '''entry point'''
+    args = parse_args()
+    try:
+        diff = fwsim.PolicyDiff(fwsim.read_rules(args.oldrulesfname),
+                                fwsim.read_rules(args.newrulesfname), args.actions_only)
+        if args.packets:
+            diff.count(args.packets)
+        regions = diff.as_dicts()
+
+        if args.json:
+            print(json.dumps(regions, indent=2))
+        else:
+            header = (f"{'dir':3} {'est':3} {'addresses':31} {'ports':11} {'old':12} {'new':12}"
+                      + (" packets" if args.packets else ""))
+            print(header.rstrip())
+            for region in regions:
+                print(format_region(region))
+
+        summary = f"{len(regions)} regions change"
+        if args.packets:
+            summary += f", {sum(diff.packets)} of {diff.total} packets in them"
+        print(summary, file=sys.stderr)
+    except BrokenPipeError:
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    except (IOError, FileNotFoundError) as e:
+        print(f"Simulator error: Error opening file: {str(e)}")
+    except Warning as e:
+        print(f"Simulator error: {e}")
+
+
+if __name__ == "__main__":
+    main()
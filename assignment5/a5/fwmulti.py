@@ -0,0 +1,95 @@
+#!/bin/env python3
+# Runs one packets file against several rules files in a single pass, for
+# reviewing policy changes: the packets are parsed once and classified by
+# every rule set. Prints the packets whose verdict differs between the rule
+# sets, or writes the full results of each rule set.
+
+import argparse
+import os
+import sys
+
+import fwsim
+
+
+def verdict(result) -> str:
+    '''action(rule_line) of one result tuple'''
+    return f"{result[0]}({result[1]})"
+
+
+def diff_header(rules_fnames) -> str:
+    names = "".join(f" {os.path.basename(fname):12}" for fname in rules_fnames)
+    return f"{'line':7} {'dir':3} {'ip':15} {'port':5} {'flag':4}{names}".rstrip()
+
+
+def diff_row(line, results, k) -> str:
+    '''one packet with the verdict of every rule set'''
+    _, _, direction, ip, port, flag = results[0][k]
+    verdicts = "".join(f" {verdict(r[k]):12}" for r in results)
+    return f"{line:<7} {direction:3} {ip:15} {port:5} {flag:4}{verdicts}".rstrip()
+
+
+def parse_args():
+    '''parse command lines'''
+    parser = argparse.ArgumentParser(
+        prog='fwmulti',
+        description='classify one packets file against several rules files in one pass',
+    )
+    parser.add_argument('packetsfname', help='filename with packets')
+    parser.add_argument('rulesfname', nargs='+', help='filenames with firewall rules')
+    parser.add_argument('--results', metavar='DIR',
+                        help='write the results of each rules file to DIR/<rules file>.results '
+                             'instead of printing the packets with differing verdicts')
+    parser.add_argument('--engine', choices=fwsim.ENGINES,
+                        help=f'rule matching engine (default: $FWSIM_ENGINE or {fwsim.DEFAULT_ENGINE})')
+    parser.add_argument('--jobs', type=int, default=0,
+                        help='worker processes for the rule sets, 0 for one per core (default: 0)')
+    parser.add_argument('--no-rules-cache', dest='rules_cache', action='store_false',
+                        help="don't read or write the compiled rules cache files")
+    return parser.parse_args()
+
+
+def main():
+    '''entry point'''
+    args = parse_args()
+    out = sys.stdout
+    outputs = []
+    try:
+        if args.results:
+            names = [os.path.basename(fname) for fname in args.rulesfname]
+            if len(set(names)) != len(names):
+                raise Warning("rules files need distinct names for --results")
+            outputs = [open(os.path.join(args.results, f"{name}.results"), "w")
+                       for name in names]
+
+        packets = differ = 0
+        for results in fwsim.fwsim_multi(args.rulesfname, args.packetsfname, args.engine,
+                                         args.jobs, args.rules_cache):
+            packets += len(results[0])
+            if outputs:
+                for fp, chunk in zip(outputs, results):
+                    chunk.write(fp)
+                continue
+            if packets == len(results[0]):
+                # first chunk, the rules compiled fine
+                out.write(diff_header(args.rulesfname) + "\n")
+            rows = fwsim.verdict_differences(results)
+            differ += len(rows)
+            lines = results[0].packets.lines
+            out.write("".join(diff_row(lines[k], results, k) + "\n" for k in rows))
+        out.flush()
+        if not outputs:
+            print(f"{differ} of {packets} packets have differing verdicts", file=sys.stderr)
+    except BrokenPipeError:
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    except (IOError, FileNotFoundError) as e:
+        print(f"Simulator error: Error opening file: {str(e)}")
+    except Warning as e:
+        out.flush()
+        print(f"Simulator error: {e}")
+    finally:
+        for fp in outputs:
+            fp.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+#!/bin/env python3
 # ==============================================================================
 # Copyright (C) 2025 Pavol Federl pfederl@ucalgary.ca
 # Do not distribute this file.
@@ -16,6 +17,40 @@
 
 #Authored By: Issam Akhtar, Abdelrehman Abbas
 
+import argparse
+import gc
+import hashlib
+import io
+import ipaddress
+import json
+import marshal
+import mmap
+import os
+import pickle
+import random
+import stat
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, OrderedDict, deque
+from collections.abc import Sequence
+from functools import cache, partial
+from itertools import accumulate, groupby, islice
+
+# numpy takes longer to import than a small run takes, so it is only
+# imported by load_numpy() where it is needed
+np = None
+_numpy_tried = False
+
+DIRECTIONS = ("in", "out")
+
+# IPv6 addresses are their 128-bit value with V6_FLAG set on top, so any ip
+# int above 0xFFFFFFFF is IPv6 and IPv4 keeps plain 32-bit ints
+V6_FLAG = 1 << 128
+V6_MASK = V6_FLAG - 1
+
+
 def ip2int(ip_str) -> int:
     if ip_str == "*":
         return 0
@@ -23,7 +58,7 @@ def ip2int(ip_str) -> int:
     try:
         oct = ip_str.split('.')
         if len(oct) != 4:
-            return None  # not enough octets in ip
+            return ip6_int(ip_str)  # not enough octets in ip, maybe IPv6
 
         for o in oct:
             value = int(o)
@@ -32,6 +67,16 @@ def ip2int(ip_str) -> int:
 
         # convert to int32: a.b.c.d = (a << 24) | (b << 16) | (c << 8) | d
         return (int(oct[0]) << 24) | (int(oct[1]) << 16) | (int(oct[2]) << 8) | int(oct[3])
+    except ValueError:
+        return ip6_int(ip_str)  # like ::ffff:1.2.3.4
+
+
+def ip6_int(ip_str) -> int:
+    """V6_FLAG | the 128-bit value of an IPv6 address, None if invalid"""
+    if ":" not in ip_str or "%" in ip_str:
+        return None
+    try:
+        return V6_FLAG | int(ipaddress.IPv6Address(ip_str))
     except ValueError:
         return None
 
@@ -44,22 +89,29 @@ def cidr_ip_range(ip_int, cidr_range) -> bool:
         ip_str, prefix_len_str = cidr_range.split('/')
         prefix_len = int(prefix_len_str)
 
-        if prefix_len < 0 or prefix_len > 32:
-            return None
-
         base_ip_int = ip2int(ip_str)
 
         if base_ip_int is None:
             return None
 
+        bits = 128 if base_ip_int > 0xFFFFFFFF else 32
+        if prefix_len < 0 or prefix_len > bits:
+            return None
+
+        # an IPv4 range never holds an IPv6 address, nor the other way round
+        if (ip_int > 0xFFFFFFFF) != (bits == 128):
+            return False
+
         # mask based on prefix length and check if in range
-        return (ip_int & 0xFFFFFFFF << (32 - prefix_len)) == (base_ip_int & 0xFFFFFFFF << (32 - prefix_len))
+        mask = ((1 << bits) - 1) >> (bits - prefix_len) << (bits - prefix_len)
+        return (ip_int & mask) == (base_ip_int & mask)
 
     except ValueError:
         return None
 
 
 def get_ports(ports_str):
+    """returns ["*"] or a list of (low, high) port ranges, None if invalid"""
     if ports_str == "*":
         return ["*"]
 
@@ -67,15 +119,73 @@ def get_ports(ports_str):
         ports = []
         for port_str in ports_str.split(','):
             if port_str:  # skip empty
-                port = int(port_str)
-                if port < 0 or port > 65535:
+                low, dash, high = port_str.partition('-')
+                low = int(low)
+                high = int(high) if dash else low
+                if low < 0 or high > 65535 or low > high:
                     return None
-                ports.append(port)
+                ports.append((low, high))
         return ports
     except ValueError:
         return None
 
 
+class PortSet:
+    """sorted, merged port ranges of one rule, membership is a bisect"""
+    __slots__ = ("starts", "ends")
+
+    def __init__(self, ranges):
+        starts, ends = [], []
+        for low, high in sorted(ranges):
+            if ends and low <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], high)
+            else:
+                starts.append(low)
+                ends.append(high)
+        self.starts = tuple(starts)
+        self.ends = tuple(ends)
+
+    def __contains__(self, port):
+        i = bisect_right(self.starts, port) - 1
+        return i >= 0 and port <= self.ends[i]
+
+    def __iter__(self):
+        return iter(zip(self.starts, self.ends))
+
+    def __reduce__(self):
+        return (_restore_port_set, (self.starts, self.ends))
+
+    def __repr__(self):
+        return f"PortSet({list(self)})"
+
+
+def _restore_port_set(starts, ends):
+    ports = PortSet.__new__(PortSet)
+    ports.starts = starts
+    ports.ends = ends
+    return ports
+
+
+def compile_ports(ranges):
+    """
+    Returns the membership structure for the ranges from get_ports(): None
+    for '*', a frozenset when only single ports are listed (hashing beats
+    bisect there), otherwise a PortSet.
+    """
+    if "*" in ranges:
+        return None
+    if all(low == high for low, high in ranges):
+        return frozenset(low for low, _ in ranges)
+    return PortSet(ranges)
+
+
+def port_ranges(ports):
+    """sorted, merged (low, high) ranges of compiled ports"""
+    if isinstance(ports, PortSet):
+        return list(ports)
+    return list(PortSet((port, port) for port in ports))
+
+
 def rule_packet_comp(rule, packet, flag_value=None):
     r_dir, r_action, r_range, r_ports, *r_flags = rule
     p_dir, p_ip, p_port, p_flag = packet
@@ -97,7 +207,8 @@ def rule_packet_comp(rule, packet, flag_value=None):
     if rule_ports_parsed is None:
         return None
 
-    if ("*" not in rule_ports_parsed and int(p_port) not in rule_ports_parsed):
+    if ("*" not in rule_ports_parsed
+            and not any(low <= int(p_port) <= high for low, high in rule_ports_parsed)):
         return False
 
     if r_flags and r_flags[0] == "established" and p_flag != "1":
@@ -135,11 +246,12 @@ def get_rules(line, i, filename):
         if ip_int is None:
             raise Warning(f"{filename}:{i}: invalid IP address '{ip_str}'")
 
+        bits = 128 if ip_int > 0xFFFFFFFF else 32
         try:
             prefix = int(prefix)
-            if prefix < 0 or prefix > 32:
-                raise Warning(
-                    f"{filename}:{i}: invalid CIDR prefix '{prefix}', must be between 0 and 32")
+            if prefix < 0 or prefix > bits:
+                raise Warning(f"{filename}:{i}: invalid CIDR prefix '{prefix}', "
+                              f"must be between 0 and {bits}")
         except ValueError:
             raise Warning(
                 f"{filename}:{i}: invalid CIDR prefix '{prefix}', must be an integer")
@@ -153,7 +265,7 @@ def get_rules(line, i, filename):
         raise Warning(
             f"{filename}:{i}: invalid flag '{fields[4]}', only 'established' is allowed")
 
-    return fields
+    return Rule(fields, i)
 
 
 def get_packet(line, i, filename):
@@ -188,77 +300,2380 @@ def get_packet(line, i, filename):
     return fields
 
 
-def fwsim(rules_fname: str, packets_fname: str) -> list[list[str]]:
+class Rule:
     """
-    This function implements the firewall simulator.
+    A rule compiled once at load time, so matching a packet against it only
+    needs integer compares and a set lookup.
+    """
+    __slots__ = ("direction", "action", "net", "mask", "ports",
+                 "established", "line", "fields")
+
+    def __init__(self, fields, line):
+        self.direction = fields[0]
+        self.action = fields[1]
+        self.net, self.mask = cidr_net_mask(fields[2])
+        # None is the wildcard marker for '*'
+        self.ports = compile_ports(get_ports(fields[3]))
+        self.established = len(fields) == 5
+        self.line = line
+        # original text fields, kept for the reference rule_packet_comp()
+        self.fields = fields
+
+    @property
+    def prefix_len(self) -> int:
+        return self.mask.bit_count()
+
+    @property
+    def family(self):
+        """4 or 6 for the address family of the network, None for '*'"""
+        if self.fields[2] == "*":
+            return None
+        return 6 if ":" in self.fields[2] else 4
 
-    Returns a list of tuples, where each tuple represents the result of 
-    matching the packet to a rule. For each packet, it inserts a tuple
-        (action, rule_line, direction, ip, port, flag)
-    into the result. 
+    def matches(self, ip_int, port, established) -> bool:
+        return ((ip_int & self.mask) == self.net
+                and (self.ports is None or port in self.ports)
+                and (established or not self.established))
+
+    def __reduce__(self):
+        # much cheaper to unpickle than the default for slotted classes
+        return (_restore_rule, (self.direction, self.action, self.net, self.mask,
+                                self.ports, self.established, self.line, self.fields))
+
+    def __repr__(self):
+        return f"Rule({' '.join(self.fields)!r}, line={self.line})"
+
+
+def _restore_rule(direction, action, net, mask, ports, established, line, fields):
+    rule = Rule.__new__(Rule)
+    rule.direction = direction
+    rule.action = action
+    rule.net = net
+    rule.mask = mask
+    rule.ports = ports
+    rule.established = established
+    rule.line = line
+    rule.fields = fields
+    return rule
+
+
+def cidr_net_mask(cidr_range):
+    """returns (network int, mask int) of an already validated range"""
+    if cidr_range == "*":
+        return 0, 0
+
+    ip_str, prefix_len_str = cidr_range.split('/')
+    if ":" in ip_str:
+        mask = (V6_MASK << (128 - int(prefix_len_str))) & V6_MASK
+    else:
+        mask = (0xFFFFFFFF << (32 - int(prefix_len_str))) & 0xFFFFFFFF
+    return ip2int(ip_str) & mask, mask
+
+
+class RuleTrie:
     """
-    results = []
-    rules = []
-    line_num = []
+    Binary prefix trie over the rule CIDRs, one per direction.
 
-    try:
-        # read rules
-        with open(rules_fname, "r", encoding="ascii") as fp:
-            rule_lines = fp.readlines()
+    Every rule is stored in the node of its prefix, so a packet only has to
+    walk the (at most 32) nodes on the path of its address and check ports
+    and the established flag of the candidates found along the way. The
+    lowest rule line that passes wins, same as a linear first-match scan.
+
+    Nodes are indices into flat lists rather than objects, which keeps large
+    tries compact and quick to pickle for the rules cache.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        # nodes 0 and 1 are the roots of the two directions
+        self.roots = {"in": 0, "out": 1}
+        self.zero = [-1, -1]  # child node for bit 0, -1 if none
+        self.one = [-1, -1]  # child node for bit 1
+        self.node_rules = [None, None]  # rules ending at the node, in rule order
+        for rule in rules:
+            self.insert(rule)
+
+    def insert(self, rule):
+        node = self.roots[rule.direction]
+        for depth in range(rule.prefix_len):
+            children = self.one if (rule.net >> (31 - depth)) & 1 else self.zero
+            if children[node] == -1:
+                children[node] = len(self.node_rules)
+                self.zero.append(-1)
+                self.one.append(-1)
+                self.node_rules.append(None)
+            node = children[node]
+
+        candidates = self.node_rules[node]
+        if candidates is None:
+            self.node_rules[node] = [rule]
+        # an earlier rule at this node taking every port and flag already
+        # wins over anything inserted after it
+        elif candidates[-1].ports is not None or candidates[-1].established:
+            candidates.append(rule)
+
+    def path_rules(self, direction, net, prefix_len):
+        """yields the rules stored on the path down to net/prefix_len"""
+        node = self.roots[direction]
+        for depth in range(prefix_len + 1):
+            if self.node_rules[node] is not None:
+                yield from self.node_rules[node]
+            if depth == prefix_len:
+                break
+            node = (self.one if (net >> (31 - depth)) & 1 else self.zero)[node]
+            if node == -1:
+                break
+
+    def lookup(self, direction, ip_int, port, established):
+        """returns the first matching rule, or None"""
+        zero, one, node_rules = self.zero, self.one, self.node_rules
+        best = None
+        node = self.roots[direction]
+        bit = 31
+        while node != -1:
+            candidates = node_rules[node]
+            if candidates is not None:
+                for rule in candidates:
+                    if best is not None and rule.line > best.line:
+                        break
+                    if ((rule.ports is None or port in rule.ports)
+                            and (established or not rule.established)):
+                        best = rule
+                        break
+            if bit < 0:
+                break
+            node = one[node] if (ip_int >> bit) & 1 else zero[node]
+            bit -= 1
+        return best
+
+
+class Prefix6Trie:
+    """
+    Path-compressed prefix trie over 128-bit IPv6 networks, one per
+    direction, holding the IPv6 rules and the '*' ones.
+
+    A node stores its whole prefix (network and length) and only branches
+    where prefixes actually diverge, so a lookup visits one node per rule
+    prefix on the address path rather than one per bit. Candidates are
+    checked like in RuleTrie, the lowest matching rule line wins. Nodes are
+    flat lists as well.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.roots = {"in": 0, "out": 1}
+        self.nets = [0, 0]  # network of the node, host bits zero
+        self.lens = [0, 0]  # prefix length of the node
+        self.zero = [-1, -1]  # child node continuing with bit 0, -1 if none
+        self.one = [-1, -1]
+        self.node_rules = [None, None]
+        for rule in rules:
+            self.insert(rule)
+
+    def new_node(self, net, length) -> int:
+        self.nets.append(net & (V6_MASK << (128 - length)) & V6_MASK)
+        self.lens.append(length)
+        self.zero.append(-1)
+        self.one.append(-1)
+        self.node_rules.append(None)
+        return len(self.node_rules) - 1
+
+    def insert(self, rule):
+        net, length = rule.net, rule.prefix_len
+        nets, lens = self.nets, self.lens
+        node = self.roots[rule.direction]
+        while lens[node] != length:
+            children = self.one if (net >> (127 - lens[node])) & 1 else self.zero
+            child = children[node]
+            if child == -1:
+                children[node] = self.new_node(net, length)
+                node = children[node]
+                break
+            common = min(lens[child], length, 128 - (net ^ nets[child]).bit_length())
+            if common < lens[child]:
+                # split the edge where the two prefixes part
+                mid = self.new_node(net, common)
+                (self.one if (nets[child] >> (127 - common)) & 1 else self.zero)[mid] = child
+                child = children[node] = mid
+            node = child
+
+        candidates = self.node_rules[node]
+        if candidates is None:
+            self.node_rules[node] = [rule]
+        elif candidates[-1].ports is not None or candidates[-1].established:
+            candidates.append(rule)
+
+    def path_rules(self, direction, net, prefix_len):
+        """yields the rules stored on the path down to net/prefix_len"""
+        nets, lens = self.nets, self.lens
+        node = self.roots[direction]
+        while node != -1 and lens[node] <= prefix_len:
+            if (net ^ nets[node]) >> (128 - lens[node]):
+                break
+            if self.node_rules[node] is not None:
+                yield from self.node_rules[node]
+            if lens[node] == prefix_len:
+                break
+            node = (self.one if (net >> (127 - lens[node])) & 1 else self.zero)[node]
+
+    def lookup(self, direction, ip_int, port, established):
+        """returns the first matching rule, or None"""
+        nets, lens, zero, one, node_rules = (
+            self.nets, self.lens, self.zero, self.one, self.node_rules)
+        ip_int &= V6_MASK
+        best = None
+        node = self.roots[direction]
+        while node != -1:
+            length = lens[node]
+            if (ip_int ^ nets[node]) >> (128 - length):
+                break  # the address leaves the compressed path
+            candidates = node_rules[node]
+            if candidates is not None:
+                for rule in candidates:
+                    if best is not None and rule.line > best.line:
+                        break
+                    if ((rule.ports is None or port in rule.ports)
+                            and (established or not rule.established)):
+                        best = rule
+                        break
+            if length == 128:
+                break
+            node = one[node] if (ip_int >> (127 - length)) & 1 else zero[node]
+        return best
+
+
+class LinearMatcher:
+    """reference engine: first-match scan over the rules in file order"""
+
+    def __init__(self, rules):
+        self.rules = rules
+
+    def lookup(self, direction, ip_int, port, established):
+        for rule in self.rules:
+            if rule.direction == direction and rule.matches(ip_int, port, established):
+                return rule
+        return None
+
+
+class BitVectorMatcher:
+    """
+    Bit vector engine in the style of Lakshman and Stiliadis: rule i is
+    bit i of a Python int. Every direction, address interval, port segment
+    and flag value gets the bitmask of the rules it matches, with the
+    direction and flag masks combined up front, so a lookup is two bisects,
+    an AND of three ints and the lowest set bit, whatever the number of
+    wildcards. The masks take rules x segments bits, so this is meant for
+    policies of up to some ten thousand rules.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        # only rules without 'established' match a flag 0 packet
+        flag_masks = {False: rule_mask(not rule.established for rule in rules),
+                      True: rule_mask(True for rule in rules)}
+        self.class_masks = {}  # (direction, established) -> mask
+        for direction in DIRECTIONS:
+            direction_mask = rule_mask(rule.direction == direction for rule in rules)
+            for established, flag_mask in flag_masks.items():
+                self.class_masks[direction, established] = direction_mask & flag_mask
+
+        addresses, ports = [], []
+        for index, rule in enumerate(rules):
+            bit = 1 << index
+            addresses.append((rule.net, rule.net + (~rule.mask & 0xFFFFFFFF) + 1, bit))
+            if rule.ports is None:
+                ports.append((0, 65536, bit))
+            else:
+                ports.extend((low, high + 1, bit) for low, high in port_ranges(rule.ports))
+        starts, self.address_masks = bit_segments(addresses, 1 << 32)
+        self.address_starts = array("I", starts)
+        starts, self.port_masks = bit_segments(ports, 65536)
+        self.port_starts = array("H", starts)
+
+    def lookup(self, direction, ip_int, port, established):
+        matching = (self.address_masks[bisect_right(self.address_starts, ip_int) - 1]
+                    & self.port_masks[bisect_right(self.port_starts, port) - 1]
+                    & self.class_masks[direction, established])
+        if not matching:
+            return None
+        return self.rules[(matching & -matching).bit_length() - 1]
+
+
+def rule_mask(flags) -> int:
+    """int with bit i set for every true flag i, built in linear time"""
+    return int("0" + "".join("1" if flag else "0" for flag in flags)[::-1], 2)
+
+
+def bit_segments(spans, limit):
+    """
+    Splits [0, limit) at the bounds of spans, given as (low, high, bit) with
+    high exclusive and disjoint spans per bit. Returns the sorted segment
+    starts and, per segment, the OR of the bits of the spans covering it.
+    """
+    toggles = {0: 0}
+    for low, high, bit in spans:
+        toggles[low] = toggles.get(low, 0) ^ bit
+        if high < limit:
+            toggles[high] = toggles.get(high, 0) ^ bit
+    starts, masks = sorted(toggles), []
+    mask = 0
+    for start in starts:
+        mask ^= toggles[start]
+        masks.append(mask)
+    return starts, masks
+
+
+class PortIndexMatcher:
+    """
+    Engine that only looks at rules which can apply to the packet's port.
+
+    At load time the port space of each direction is cut into segments at
+    every rule's port range boundaries, and each segment keeps the sorted
+    indices of the rules listing it; wildcard-port rules go into a separate
+    list per direction. A lookup bisects to the packet's segment, merges it
+    with the wildcard list in rule order and stops at the first rule whose
+    CIDR and flag also match. Counters for stats() are kept as packets are
+    looked up.
+    """
 
-        for i, line in enumerate(rule_lines, 1):  # enumerate also keeps iter num
-            # comments
-            if '#' in line:
-                line = line[:line.find('#')]
-            l = line.strip()
+    def __init__(self, rules):
+        self.rules = rules
+        self.bounds = {}  # direction -> sorted segment starts
+        self.segments = {}  # direction -> sorted rule indices per segment
+        self.wildcard = {direction: [] for direction in DIRECTIONS}
+        listed = {direction: [] for direction in DIRECTIONS}
+        for index, rule in enumerate(rules):
+            if rule.ports is None:
+                self.wildcard[rule.direction].append(index)
+            else:
+                listed[rule.direction].append((index, port_ranges(rule.ports)))
+
+        for direction, entries in listed.items():
+            bounds = {0}
+            for _, ranges in entries:
+                for low, high in ranges:
+                    bounds.update((low, high + 1))
+            bounds = sorted(b for b in bounds if b <= 65535)
+            segments = [[] for _ in bounds]
+            for index, ranges in entries:
+                for low, high in ranges:
+                    for k in range(bisect_left(bounds, low), bisect_left(bounds, high + 1)):
+                        segments[k].append(index)
+            self.bounds[direction] = bounds
+            self.segments[direction] = segments
+
+        self.lookups = 0
+        self.examined = 0
+
+    def lookup(self, direction, ip_int, port, established):
+        rules = self.rules
+        listed = self.segments[direction][bisect_right(self.bounds[direction], port) - 1]
+        wild = self.wildcard[direction]
+        n_listed, n_wild = len(listed), len(wild)
+        i = j = 0
+        rule = None
+        while i < n_listed or j < n_wild:
+            if j == n_wild or (i < n_listed and listed[i] < wild[j]):
+                candidate = rules[listed[i]]
+                i += 1
+            else:
+                candidate = rules[wild[j]]
+                j += 1
+            if ((ip_int & candidate.mask) == candidate.net
+                    and (established or not candidate.established)):
+                rule = candidate
+                break
+        self.lookups += 1
+        self.examined += i + j
+        return rule
+
+    def stats(self) -> dict:
+        buckets = [len(segment) for segments in self.segments.values()
+                   for segment in segments if segment]
+        return {
+            "engine": "portindex",
+            "rules": len(self.rules),
+            "port_segments": len(buckets),
+            "avg_segment_size": sum(buckets) / len(buckets) if buckets else 0.0,
+            "wildcard_rules": {d: len(w) for d, w in self.wildcard.items()},
+            "lookups": self.lookups,
+            "candidates_examined": self.examined,
+            "avg_candidates_per_packet": self.examined / self.lookups if self.lookups else 0.0,
+        }
+
+
+class IntervalMatcher:
+    """
+    Engine over the address space flattened into disjoint intervals.
+
+    For each direction and flag class (established or not) the 32-bit
+    address space is split at every rule's network boundaries, and each
+    interval keeps the rules covering it in rule order, cut after the first
+    rule taking every port since nothing later can win. A lookup is a bisect
+    on the array('I') of interval starts followed by port checks.
+
+    With resolve_ports the port space of every interval is also cut into
+    segments that each know their deciding rule, so a lookup is two bisects
+    and no rule checks at all, at the cost of more memory.
+    """
+
+    def __init__(self, rules, resolve_ports=False):
+        self.rules = rules
+        self.resolve_ports = resolve_ports
+        self.starts = {}  # (direction, established) -> array('I') of interval starts
+        self.covers = {}  # (direction, established) -> per interval rules or port segments
+        for direction in DIRECTIONS:
+            for established in (False, True):
+                applicable = [rule for rule in rules if rule.direction == direction
+                              and (established or not rule.established)]
+                starts, covers = address_intervals(applicable)
+                if resolve_ports:
+                    resolved = {}
+                    covers = [resolved.setdefault(id(c), port_segments(c)) for c in covers]
+                self.starts[direction, established] = array("I", starts)
+                self.covers[direction, established] = covers
+
+    def lookup(self, direction, ip_int, port, established):
+        key = (direction, established)
+        covering = self.covers[key][bisect_right(self.starts[key], ip_int) - 1]
+        if self.resolve_ports:
+            bounds, decided = covering
+            return decided[bisect_right(bounds, port) - 1]
+        for rule in covering:
+            if rule.ports is None or port in rule.ports:
+                return rule
+        return None
+
+
+def address_intervals(rules, last=0xFFFFFFFF):
+    """
+    Splits the address space up to last (V6_MASK for IPv6) at the network
+    boundaries of rules. Returns the sorted interval starts and, per
+    interval, the tuple of rules covering it in rule order, up to the first
+    rule taking every port. Equal tuples are shared between intervals.
+    """
+    events = {0: ([], [])}
+    for index, rule in enumerate(rules):
+        end = rule.net + (~rule.mask & last) + 1
+        events.setdefault(rule.net, ([], []))[0].append(index)
+        if end <= last:
+            events.setdefault(end, ([], []))[1].append(index)
+
+    starts, covers, shared = [], [], {}
+    active = []  # sorted indices of the rules covering the current interval
+    for start in sorted(events):
+        opened, closed = events[start]
+        for index in closed:
+            active.remove(index)
+        for index in opened:
+            insort(active, index)
+        covering = []
+        for index in active:
+            covering.append(rules[index])
+            if rules[index].ports is None:
+                break
+        covering = tuple(covering)
+        starts.append(start)
+        covers.append(shared.setdefault(covering, covering))
+    return starts, covers
+
+
+def port_segments(covering):
+    """
+    Resolves the rules covering one address interval per port: returns the
+    sorted port segment starts and the deciding rule (or None) of each.
+    """
+    bounds = {0}
+    for rule in covering:
+        if rule.ports is not None:
+            for low, high in port_ranges(rule.ports):
+                bounds.update((low, high + 1))
+    bounds = tuple(sorted(b for b in bounds if b <= 65535))
+    decided = []
+    for port in bounds:
+        for rule in covering:
+            if rule.ports is None or port in rule.ports:
+                decided.append(rule)
+                break
+        else:
+            decided.append(None)
+    return bounds, tuple(decided)
+
+
+def load_numpy() -> bool:
+    """imports numpy as np on first use, returns False if it isn't installed"""
+    global np, _numpy_tried
+    if not _numpy_tried:
+        _numpy_tried = True
+        try:
+            import numpy as np
+        except ImportError:
+            pass
+    return np is not None
+
+
+class VectorMatcher:
+    """
+    Batch engine classifying whole columns of packets with NumPy.
+
+    Each rule is evaluated as a boolean mask over the rows that are still
+    unmatched, and rows drop out of the working set as soon as they match,
+    so later rules only look at what earlier rules left over.
+    """
 
-            if not l:
+    def __init__(self, rules):
+        if not load_numpy():
+            raise Warning("the vectorized engine needs numpy installed")
+        self.rules = rules
+        self.compiled = []
+        for rule in rules:
+            ports = rule.ports
+            if isinstance(ports, frozenset):
+                ports = np.array(sorted(ports), dtype=np.uint16)
+            elif ports is not None:
+                ports = (np.array(ports.starts, dtype=np.uint16),
+                         np.array(ports.ends, dtype=np.uint16))
+            self.compiled.append((DIRECTIONS.index(rule.direction),
+                                  np.uint32(rule.net), np.uint32(rule.mask),
+                                  ports, rule.established))
+
+    def __setstate__(self, state):
+        # loaded from the rules cache or in a worker, without __init__()
+        load_numpy()
+        self.__dict__.update(state)
+
+    def lookup(self, direction, ip_int, port, established):
+        return LinearMatcher.lookup(self, direction, ip_int, port, established)
+
+    def classify_columns(self, dirs, ips, ports, flags):
+        """returns an array with the index of the matching rule per row, -1 for default"""
+        decided = np.full(len(dirs), -1, dtype=np.int32)
+        rows = np.arange(len(dirs))
+        for index, (direction, net, mask, rule_ports, established) in enumerate(self.compiled):
+            if rows.size == 0:
+                break
+            hit = (dirs == direction) & ((ips & mask) == net)
+            if isinstance(rule_ports, tuple):
+                # port ranges: find the range starting at or before each port
+                starts, ends = rule_ports
+                k = np.searchsorted(starts, ports, side="right") - 1
+                hit &= (k >= 0) & (ports <= ends[np.maximum(k, 0)])
+            elif rule_ports is not None:
+                hit &= np.isin(ports, rule_ports)
+            if established:
+                hit &= flags == 1
+            if not hit.any():
                 continue
+            decided[rows[hit]] = index
+            left = ~hit
+            rows, dirs, ips, ports, flags = (
+                rows[left], dirs[left], ips[left], ports[left], flags[left])
+        return decided
+
+    def lookup_batch(self, packets):
+        """classifies a list of validated packets, returns a list of Rule or None"""
+        n = len(packets)
+        decided = self.classify_columns(
+            np.fromiter((DIRECTIONS.index(p[0]) for p in packets), np.uint8, n),
+            np.fromiter((ip2int(p[1]) for p in packets), np.uint32, n),
+            np.fromiter((int(p[2]) for p in packets), np.uint16, n),
+            np.fromiter((p[3] == "1" for p in packets), np.uint8, n))
+        rules = self.rules
+        return [rules[i] if i >= 0 else None for i in decided.tolist()]
+
+    def lookup_columns(self, columns):
+        """classifies PacketColumns without copying them, returns a list of Rule or None"""
+        decided = self.classify_columns(
+            np.frombuffer(columns.dirs, dtype=np.uint8),
+            np.frombuffer(columns.ips, dtype=np.uint32),
+            np.frombuffer(columns.ports, dtype=np.uint16),
+            np.frombuffer(columns.flags, dtype=np.uint8))
+        rules = self.rules
+        return [rules[i] if i >= 0 else None for i in decided.tolist()]
+
+
+class CodegenMatcher:
+    """
+    Engine that turns the rules into the source of one Python function:
+    an if block per direction holding the rules in order as integer
+    compares with every constant inlined, rules on the same network nested
+    under a single address test, and nothing after a rule that takes every
+    packet. The source is compiled once with compile(); .source keeps it
+    for debugging. Pickles as the marshalled code object, so a cached
+    matcher doesn't compile again.
+    """
+
+    def __init__(self, rules, source=None, code=None):
+        self.rules = rules
+        self.source = source if source is not None else generate_source(rules)
+        if code is None:
+            code = compile(self.source, "<fwsim rules>", "exec")
+        self.code = code
+        namespace = {"R": rules}
+        exec(code, namespace)
+        self.lookup = namespace["lookup"]
+
+    def __reduce__(self):
+        # attributes set after building, like .policy and .v6, go along as state
+        state = {name: value for name, value in vars(self).items()
+                 if name not in ("rules", "source", "code", "lookup")}
+        return (_restore_codegen, (self.rules, self.source, marshal.dumps(self.code)), state)
+
+
+def _restore_codegen(rules, source, code):
+    return CodegenMatcher(rules, source, marshal.loads(code))
+
+
+def address_condition(rule) -> str:
+    if rule.mask == 0:
+        return ""
+    if rule.mask == 0xFFFFFFFF:
+        return f"ip_int == {rule.net:#x}"
+    return f"ip_int & {rule.mask:#x} == {rule.net:#x}"
+
+
+def port_condition(rule) -> str:
+    if rule.ports is None:
+        return ""
+    ranges = port_ranges(rule.ports)
+    if not ranges:
+        # a ports field of just ',' leaves no port, the rule never matches
+        return "False"
+    if ranges == [(0, 65535)]:
+        return ""
+    singles = [low for low, high in ranges if low == high]
+    tests = [f"{low} <= port <= {high}" for low, high in ranges if low != high]
+    if len(singles) == 1:
+        tests.insert(0, f"port == {singles[0]}")
+    elif singles:
+        # a set display of constants compiles to a frozenset constant
+        tests.insert(0, f"port in {{{', '.join(map(str, singles))}}}")
+    if len(tests) == 1:
+        return tests[0]
+    return "(" + " or ".join(tests) + ")"
+
+
+def rule_condition(rule) -> str:
+    """what a packet must satisfy besides the address to match rule"""
+    tests = [port_condition(rule)]
+    if tests == ["False"]:
+        return "False"
+    if rule.established:
+        tests.append("established")
+    return " and ".join(test for test in tests if test)
+
+
+def generate_source(rules) -> str:
+    """Python source of lookup(direction, ip_int, port, established) for rules"""
+    out = ["def lookup(direction, ip_int, port, established):"]
+    for d, direction in enumerate(DIRECTIONS):
+        out.append(f"    {'if' if d == 0 else 'elif'} direction == {direction!r}:")
+        body = len(out)
+        indexed = [(index, rule) for index, rule in enumerate(rules)
+                   if rule.direction == direction]
+        for _, group in groupby(indexed, lambda item: (item[1].net, item[1].mask)):
+            group = list(group)
+            address = address_condition(group[0][1])
+            indent = "        "
+            if address:
+                out.append(f"{indent}if {address}:")
+                indent += "    "
+            catch_all = False
+            for index, rule in group:
+                condition = rule_condition(rule)
+                out.append(f"{indent}# line {rule.line}: {' '.join(rule.fields)}")
+                if condition:
+                    out.append(f"{indent}if {condition}: return R[{index}]")
+                else:
+                    # later rules on this network are unreachable
+                    out.append(f"{indent}return R[{index}]")
+                    catch_all = True
+                    break
+            if catch_all and not address:
+                break
+        if len(out) == body:
+            out.append("        pass")
+    out.append("    return None")
+    return "\n".join(out) + "\n"
+
+
+# engine registry: name -> factory taking the list of Rules. A matcher has
+# .rules and lookup(direction, ip_int, port, established) returning the
+# deciding Rule or None; batch engines may add lookup_batch(packets) and
+# lookup_columns(columns).
+ENGINES = {
+    "linear": LinearMatcher,
+    "bitvector": BitVectorMatcher,
+    "trie": RuleTrie,
+    "portindex": PortIndexMatcher,
+    "interval": IntervalMatcher,
+    "interval-ports": partial(IntervalMatcher, resolve_ports=True),
+    "vectorized": VectorMatcher,
+    "codegen": CodegenMatcher,
+}
+
+# engine used when none is given and FWSIM_ENGINE isn't set
+DEFAULT_ENGINE = "trie"
+
+# packets handed to batch engines at once
+BATCH_SIZE = 65536
+
+
+def register_engine(name, factory):
+    """adds an engine to ENGINES, replacing one of the same name"""
+    ENGINES[name] = factory
+
+
+def resolve_engine(engine=None) -> str:
+    """
+    Returns the engine name to use: engine, or the FWSIM_ENGINE environment
+    variable, or DEFAULT_ENGINE. Raises Warning for an unknown name.
+    """
+    engine = engine or os.environ.get("FWSIM_ENGINE") or DEFAULT_ENGINE
+    if engine not in ENGINES:
+        raise Warning(f"unknown engine '{engine}', must be one of {', '.join(ENGINES)}")
+    return engine
+
+
+class ShadowMatcher:
+    """
+    Wraps a matcher and checks a sampled fraction rate of its decisions
+    against the reference rule_packet_comp() scan over the rules as written
+    (.policy, so an optimized matcher is checked too), raising Warning on
+    the first mismatch. With actions_only, for matchers without redundant
+    rules, only the actions have to agree. Batch lookups are sampled by
+    row; behind a DecisionCache only the misses reach it. .checked counts
+    the decisions compared. lookup() also takes IPv6 packets, decided by
+    the IPv6 index of the matcher and checked the same way.
+    """
+
+    def __init__(self, matcher, rate=0.01, seed=526, actions_only=False):
+        self.matcher = matcher
+        self.rules = matcher.rules
+        self.policy = getattr(matcher, "policy", matcher.rules)
+        self.actions_only = actions_only
+        self.lookup6 = getattr(matcher, "v6", matcher).lookup
+        self.rate = rate
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.checked = 0
+        # only offer the batch interfaces the engine has
+        if hasattr(matcher, "lookup_batch"):
+            self.lookup_batch = self._lookup_batch
+        if hasattr(matcher, "lookup_columns"):
+            self.lookup_columns = self._lookup_columns
+
+    def __reduce__(self):
+        return (ShadowMatcher, (self.matcher, self.rate, self.seed, self.actions_only))
+
+    def check(self, packet, rule):
+        """compares rule, decided for the packet string fields, with the reference"""
+        self.checked += 1
+        for expected in self.policy:
+            if rule_packet_comp(expected.fields, packet):
+                break
+        else:
+            expected = None
+        if self.actions_only:
+            agree = (rule.action if rule else None) == (expected.action if expected else None)
+        else:
+            agree = expected is rule
+        if not agree:
+            raise Warning(f"engine mismatch for packet '{' '.join(packet)}': decided "
+                          f"{decision_text(rule)}, reference {decision_text(expected)}")
+
+    def sample(self, n) -> list[int]:
+        """rows of a batch of n to check"""
+        k = n * self.rate
+        k = min(int(k) + (self.rng.random() < k - int(k)), n)
+        return sorted(self.rng.sample(range(n), k))
+
+    def lookup(self, direction, ip_int, port, established):
+        if ip_int <= 0xFFFFFFFF:
+            rule = self.matcher.lookup(direction, ip_int, port, established)
+        else:
+            rule = self.lookup6(direction, ip_int, port, established)
+        if self.rng.random() < self.rate:
+            ip = int2ip(ip_int) if ip_int <= 0xFFFFFFFF else int2ip6(ip_int)
+            self.check((direction, ip, str(port), "1" if established else "0"), rule)
+        return rule
+
+    def _lookup_batch(self, packets):
+        decided = self.matcher.lookup_batch(packets)
+        for k in self.sample(len(packets)):
+            self.check(packets[k], decided[k])
+        return decided
+
+    def _lookup_columns(self, columns):
+        decided = self.matcher.lookup_columns(columns)
+        for k in self.sample(len(columns)):
+            # IPv6 rows are placeholders here, decide_columns() sends them to lookup()
+            if k not in columns.v6:
+                self.check(columns.packet(k), decided[k])
+        return decided
+
+
+def ports_cover(outer, inner) -> bool:
+    """True if the compiled ports outer include every port of inner"""
+    if outer is None:
+        return True
+    if inner is None:
+        return False
+    if isinstance(outer, frozenset) and isinstance(inner, frozenset):
+        return inner <= outer
+    outer = PortSet(port_ranges(outer))
+    for low, high in port_ranges(inner):
+        i = bisect_right(outer.starts, low) - 1
+        if i < 0 or high > outer.ends[i]:
+            return False
+    return True
+
+
+def rule_covers(outer, inner) -> bool:
+    """True if outer matches every packet inner matches"""
+    return (outer.direction == inner.direction
+            and (outer.family is None or outer.family == inner.family)
+            and outer.mask & inner.mask == outer.mask
+            and inner.net & outer.mask == outer.net
+            and (inner.established or not outer.established)
+            and ports_cover(outer.ports, inner.ports))
 
-            rule = get_rules(l, i, rules_fname)
-            rules.append(rule)
-            line_num.append(i)
 
-        # read packets
-        with open(packets_fname, "r", encoding="ascii") as fp:
-            packet_lines = fp.readlines()
+def analyze_rules(rules) -> dict:
+    """
+    Finds rules that don't contribute anything to the policy.
+
+    A rule is shadowed when a single earlier rule with a covering CIDR, a
+    superset of its ports and the same or looser flag takes all of its
+    packets first; it can never match. A rule is redundant when the next
+    rule of the same direction has the same action and covers it: dropping
+    it changes no action, only the rule line reported. Earlier rules are
+    found through a prefix trie per address family, so this stays fast for
+    large policies.
+
+    Returns a dict from rule line to {"status": "shadowed", "by": line} or
+    {"status": "redundant", "next": line}.
+    """
+    report = {}
+    trie, trie6 = RuleTrie([]), Prefix6Trie([])
+    live = []  # rules that can still match, in order
+    for rule in rules:
+        search = trie6 if rule.family == 6 else trie
+        for earlier in search.path_rules(rule.direction, rule.net, rule.prefix_len):
+            if rule_covers(earlier, rule):
+                report[rule.line] = {"status": "shadowed", "by": earlier.line}
+                break
+        else:
+            # '*' rules go into both
+            if rule.family != 6:
+                trie.insert(rule)
+            if rule.family != 4:
+                trie6.insert(rule)
+            live.append(rule)
+
+    following = {}
+    for rule in reversed(live):
+        after = following.get(rule.direction)
+        if after is not None and after.action == rule.action and rule_covers(after, rule):
+            report[rule.line] = {"status": "redundant", "next": after.line}
+        following[rule.direction] = rule
+    return dict(sorted(report.items()))
+
+
+def optimize_rules(rules, drop_redundant=False):
+    """
+    Returns rules without the shadowed ones, which never changes a result.
+    With drop_redundant redundant rules go too; actions stay the same, but
+    their packets are then reported with the line of the rule after them.
+    """
+    report = analyze_rules(rules)
+    drop = {line for line, found in report.items()
+            if found["status"] == "shadowed" or drop_redundant}
+    return [rule for rule in rules if rule.line not in drop]
+
 
-        for i, line in enumerate(packet_lines, 1):
-            # commenrs
-            if '#' in line:
-                line = line[:line.find('#')]
-            l = line.strip()
+def decision_text(rule) -> str:
+    """action(rule_line) as in the output, default() for no rule"""
+    return f"{rule.action}({rule.line})" if rule is not None else "default()"
+
+
+class PolicyDiff:
+    """
+    Where two rule sets decide packets differently, worked out from the
+    rules alone.
+
+    For every direction and flag the address space is cut at the network
+    boundaries of both rule sets and the port space of every interval at
+    the port bounds of both (see address_intervals() and port_segments()).
+    Regions where the deciding rule differs are kept, or only those where
+    the action differs with actions_only, and neighbours with the same
+    change are merged. The cost grows with the rules, not with traffic.
+
+    .regions lists (direction, established, ip low, ip high, port low,
+    port high, old rule, new rule) with inclusive bounds; count() tells how
+    many packets of a trace land in each. The IPv4 and IPv6 address spaces
+    are compared separately, IPv6 regions come after the IPv4 ones and
+    their bounds are ip ints like ip2int() gives.
+    """
 
-            if not l:
+    def __init__(self, old_rules, new_rules, actions_only=False):
+        self.actions_only = actions_only
+        self.regions = []
+        self.packets = None  # per region, and all packets in total, after count()
+        self.total = None
+        # (direction, established, family) -> interval starts, and per
+        # interval the (port lows, port highs, region indices) of its changes
+        self.starts = {}
+        self.changes = {}
+        for family in (4, 6):
+            for direction in DIRECTIONS:
+                for established in (False, True):
+                    self._compare(direction, established, family, old_rules, new_rules)
+
+    def _differ(self, old, new) -> bool:
+        if self.actions_only:
+            return (old.action if old else "default") != (new.action if new else "default")
+        return decision_text(old) != decision_text(new)
+
+    def _port_changes(self, old_covering, new_covering):
+        old_bounds, old_decided = port_segments(old_covering)
+        new_bounds, new_decided = port_segments(new_covering)
+        bounds = sorted(set(old_bounds) | set(new_bounds))
+        changes = []
+        for k, low in enumerate(bounds):
+            old = old_decided[bisect_right(old_bounds, low) - 1]
+            new = new_decided[bisect_right(new_bounds, low) - 1]
+            if not self._differ(old, new):
                 continue
+            high = bounds[k + 1] - 1 if k + 1 < len(bounds) else 65535
+            last = changes[-1] if changes else None
+            if last and last[1] == low - 1 and last[2] is old and last[3] is new:
+                changes[-1] = (last[0], high, old, new)
+            else:
+                changes.append((low, high, old, new))
+        return tuple(changes)
+
+    def _compare(self, direction, established, family, old_rules, new_rules):
+        def applicable(rules):
+            return [rule for rule in rules if rule.direction == direction
+                    and rule.family in (None, family) and (established or not rule.established)]
+
+        last, flag = (0xFFFFFFFF, 0) if family == 4 else (V6_MASK, V6_FLAG)
+        old_starts, old_covers = address_intervals(applicable(old_rules), last)
+        new_starts, new_covers = address_intervals(applicable(new_rules), last)
+        intervals = []
+        resolved = {}  # covering tuples are shared, so are their port changes
+        for start in sorted(set(old_starts) | set(new_starts)):
+            old_covering = old_covers[bisect_right(old_starts, start) - 1]
+            new_covering = new_covers[bisect_right(new_starts, start) - 1]
+            key = (id(old_covering), id(new_covering))
+            changes = resolved.get(key)
+            if changes is None:
+                changes = resolved[key] = self._port_changes(old_covering, new_covering)
+            if not intervals or intervals[-1][1] != changes:
+                intervals.append((start, changes))
+
+        starts, per_interval = array("I") if family == 4 else [], []
+        for k, (start, changes) in enumerate(intervals):
+            end = intervals[k + 1][0] - 1 if k + 1 < len(intervals) else last
+            ids = []
+            for low, high, old, new in changes:
+                ids.append(len(self.regions))
+                self.regions.append((direction, established, start | flag, end | flag,
+                                     low, high, old, new))
+            starts.append(start | flag)
+            per_interval.append((array("H", [c[0] for c in changes]),
+                                 array("H", [c[1] for c in changes]), ids))
+        self.starts[direction, established, family] = starts
+        self.changes[direction, established, family] = per_interval
+
+    def region_of(self, direction, ip_int, port, established):
+        """index into .regions of a packet, None where both decide alike"""
+        key = (direction, established, 6 if ip_int > 0xFFFFFFFF else 4)
+        lows, highs, ids = self.changes[key][bisect_right(self.starts[key], ip_int) - 1]
+        k = bisect_right(lows, port) - 1
+        if k >= 0 and port <= highs[k]:
+            return ids[k]
+        return None
 
-            packet = get_packet(l, i, packets_fname)
-            # match flag
-            match = False
+    def count(self, packets_fname):
+        """counts the packets of a packets file or trace per region into .packets"""
+        self.packets = counts = [0] * len(self.regions)
+        self.total = 0
+        region_of = self.region_of
+        for columns in iter_packet_columns(packets_fname):
+            self.total += len(columns)
+            v6 = columns.v6
+            for k, (d, ip_int, port, flag) in enumerate(zip(columns.dirs, columns.ips,
+                                                            columns.ports, columns.flags)):
+                if k in v6:
+                    ip_int = v6[k]
+                region = region_of(DIRECTIONS[d], ip_int, port, flag == 1)
+                if region is not None:
+                    counts[region] += 1
+        return counts
+
+    def as_dicts(self) -> list[dict]:
+        out = []
+        for k, (direction, established, ip_low, ip_high, port_low, port_high,
+                old, new) in enumerate(self.regions):
+            region = {
+                "direction": direction,
+                "established": established,
+                "addresses": (f"{int2ip(ip_low)}-{int2ip(ip_high)}" if ip_low <= 0xFFFFFFFF
+                              else f"{int2ip6(ip_low)}-{int2ip6(ip_high)}"),
+                "ports": f"{port_low}-{port_high}" if port_low != port_high else str(port_low),
+                "old": decision_text(old),
+                "new": decision_text(new),
+            }
+            if self.packets is not None:
+                region["packets"] = self.packets[k]
+            out.append(region)
+        return out
+
+
+class DecisionCache:
+    """
+    Bounded LRU cache of decisions in front of a matcher.
 
-            for i, rule in enumerate(rules):
-                result = rule_packet_comp(rule, packet)
+    Keys are parsed packets (direction, ip int, port int, established) and
+    values the matching Rule (None for the default policy). Binding the cache
+    to a new matcher, i.e. a new rule set, drops every cached decision.
+    """
 
-                if result is None:
-                    # final check for errors
-                    raise Warning(
-                        f"{rules_fname}:{line_num[i]}: error processing rule")
+    def __init__(self, size=4096):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.matcher = None
+        self.entries = OrderedDict()
 
-                if result:
-                    # result(action, rule_line, direction, ip, port, flag)
-                    results.append(
-                        (rule[1], str(line_num[i]), packet[0], packet[1], packet[2], packet[3]))
-                    match = True
-                    break
+    def bind(self, matcher):
+        self.matcher = matcher
+        self.clear()
+
+    def clear(self):
+        self.entries.clear()
+
+    def lookup(self, direction, ip_int, port, established):
+        key = (direction, ip_int, port, established)
+        entries = self.entries
+        try:
+            rule = entries[key]
+        except KeyError:
+            self.misses += 1
+            rule = self.matcher.lookup(direction, ip_int, port, established)
+            entries[key] = rule
+            if len(entries) > self.size:
+                entries.popitem(last=False)
+            return rule
+        self.hits += 1
+        entries.move_to_end(key)
+        return rule
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class FlowTable:
+    """
+    Connection tracking in front of a matcher.
+
+    A non-established packet accepted by a rule opens its flow (direction,
+    ip int, port); established packets of an open flow are then answered
+    with that rule without a lookup. Time is counted in packets: a flow not
+    seen for more than idle packets is closed, and past size open flows the
+    least recently seen one is. Binding a new matcher closes every flow.
+
+    This is stateful: an established packet of an open flow gets the rule
+    that accepted the flow even where the rules alone would pick an earlier
+    'established' rule. With verify every answer from the table is looked up
+    again without it and the differences are counted in mismatches.
+    """
+
+    def __init__(self, size=65536, idle=1000000, verify=False):
+        self.size = size
+        self.idle = idle
+        self.verify = verify
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.mismatches = 0
+        self.clock = 0
+        self.matcher = None
+        # (direction, ip int, port) -> (Rule, clock when last seen), oldest first
+        self.flows = OrderedDict()
+
+    def bind(self, matcher):
+        self.matcher = matcher
+        self.clear()
+
+    def clear(self):
+        self.flows.clear()
+        self.clock = 0
+
+    def lookup(self, direction, ip_int, port, established):
+        self.clock += 1
+        key = (direction, ip_int, port)
+        flows = self.flows
+        if established:
+            entry = flows.get(key)
+            if entry is None or self.clock - entry[1] > self.idle:
+                self.misses += 1
+                return self.matcher.lookup(direction, ip_int, port, True)
+            self.hits += 1
+            rule = entry[0]
+            flows[key] = (rule, self.clock)
+            flows.move_to_end(key)
+            if self.verify and self.matcher.lookup(direction, ip_int, port, True) is not rule:
+                self.mismatches += 1
+            return rule
+
+        rule = self.matcher.lookup(direction, ip_int, port, False)
+        if rule is not None and rule.action == "accept":
+            flows[key] = (rule, self.clock)
+            flows.move_to_end(key)
+            self.expire()
+        return rule
+
+    def expire(self):
+        '''closes idle flows, and the oldest ones while there are too many'''
+        flows = self.flows
+        oldest = self.clock - self.idle
+        while flows and (len(flows) > self.size or next(iter(flows.values()))[1] < oldest):
+            flows.popitem(last=False)
+            self.evictions += 1
+
+    @property
+    def hit_rate(self) -> float:
+        '''share of established packets answered from the table'''
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class RuleStats:
+    """
+    Opt-in per rule statistics, collected from the results as they go by.
+
+    Depth is measured against the policy as written: a packet decided by
+    the n-th rule examined n rules, one getting the default examined all
+    of them, and every rule before the deciding one was examined without
+    matching, whatever engine actually made the decision.
+    """
+
+    def __init__(self):
+        self.rules = []
+        self.hits = Counter()  # rule line as in results ('' for default) -> packets
+
+    def bind(self, rules):
+        self.rules = rules
+
+    def collect(self, results):
+        """passes results through, counting the deciding rule of each"""
+        hits = self.hits
+        for result in results:
+            hits[result[1]] += 1
+            yield result
+
+    def as_dict(self) -> dict:
+        total = sum(self.hits.values())
+        default = self.hits[""]
+        per_rule = {}
+        examined = Counter()
+        reaching = total  # packets not decided by an earlier rule
+        for position, rule in enumerate(self.rules, 1):
+            hits = self.hits[str(rule.line)]
+            per_rule[rule.line] = {"hits": hits, "examined_no_match": reaching - hits}
+            reaching -= hits
+            if hits:
+                examined[position] += hits
+        if default:
+            examined[len(self.rules)] += default
+        return {
+            "packets": total,
+            "default": default,
+            "rules": per_rule,
+            "rules_examined": {n: examined[n] for n in sorted(examined)},
+            "avg_rules_examined": (sum(n * c for n, c in examined.items()) / total
+                                   if total else 0.0),
+        }
+
+
+def iter_lines(fp, first_line=1):
+    """yields (line number, stripped line) for non-blank, non-comment lines"""
+    for i, line in enumerate(fp, first_line):  # enumerate also keeps iter num
+        # comments
+        if '#' in line:
+            line = line[:line.find('#')]
+        l = line.strip()
+
+        if l:
+            yield i, l
+
+
+def read_lines(fname):
+    with open(fname, "r", encoding="ascii") as fp:
+        yield from iter_lines(fp)
+
+
+def read_rules(rules_fname):
+    with open(rules_fname, "rb") as fp:
+        return parse_rules(fp.read(), rules_fname)
+
+
+def parse_rules(data, rules_fname):
+    """the rules in data, the bytes of rules_fname, read like a text file"""
+    text = io.StringIO(data.decode("ascii"), newline=None)
+    return [get_rules(l, i, rules_fname) for i, l in iter_lines(text)]
+
+
+def read_packets(packets_fname):
+    """lazily yields validated packets, one line at a time"""
+    for i, l in read_lines(packets_fname):
+        yield get_packet(l, i, packets_fname)
+
+
+def result_tuple(rule, packet):
+    if rule is not None:
+        # result(action, rule_line, direction, ip, port, flag)
+        return (rule.action, str(rule.line), packet[0], packet[1], packet[2], packet[3])
+    # no match then use default
+    return ("default", "", packet[0], packet[1], packet[2], packet[3])
+
+
+def classify(matcher, packets, cache=None, flows=None):
+    """
+    Yields the result tuple of every packet in packets.
+
+    Decisions of per-packet engines go through a DecisionCache; pass one in
+    to pick its size (0 turns caching off) or to read its hit/miss counters
+    afterwards. Batch engines get packets BATCH_SIZE at a time and skip the
+    cache. A FlowTable as flows puts connection tracking in front of all
+    that, packet by packet, for every engine. IPv6 packets skip all of it
+    and go straight to the IPv6 index in matcher.v6.
+    """
+    lookup6 = getattr(matcher, "v6", matcher).lookup
+    if hasattr(matcher, "lookup_batch") and flows is None:
+        while True:
+            batch = list(islice(packets, BATCH_SIZE))
+            if not batch:
+                break
+            v6 = {k for k, packet in enumerate(batch) if ":" in packet[1]}
+            if not v6:
+                decided = matcher.lookup_batch(batch)
+            else:
+                v4 = iter(matcher.lookup_batch(
+                    [packet for k, packet in enumerate(batch) if k not in v6]))
+                decided = [lookup6(packet[0], ip2int(packet[1]), int(packet[2]),
+                                   packet[3] == "1") if k in v6 else next(v4)
+                           for k, packet in enumerate(batch)]
+            for packet, rule in zip(batch, decided):
+                yield result_tuple(rule, packet)
+        return
+
+    if cache is None:
+        cache = DecisionCache()
+    if cache.size > 0:
+        cache.bind(matcher)
+        matcher = cache
+    if flows is not None:
+        flows.bind(matcher)
+        matcher = flows
+
+    lookup = matcher.lookup
+    for packet in packets:
+        ip_int = ip2int(packet[1])
+        rule = (lookup if ip_int <= 0xFFFFFFFF else lookup6)(
+            packet[0], ip_int, int(packet[2]), packet[3] == "1")
+        yield result_tuple(rule, packet)
+
+
+def int2ip(ip_int) -> str:
+    return f"{ip_int >> 24}.{(ip_int >> 16) & 255}.{(ip_int >> 8) & 255}.{ip_int & 255}"
+
+
+def int2ip6(ip_int) -> str:
+    """compressed text form of an IPv6 ip int from ip2int()"""
+    return str(ipaddress.IPv6Address(ip_int & V6_MASK))
+
+
+class PacketColumns:
+    """
+    Parsed packets as compact typed arrays, one entry per packet: direction
+    (index into DIRECTIONS), ip, port, flag and the line in the packets file.
+
+    IPv6 addresses don't fit the ips array; their rows hold 0 there and the
+    ip int from ip2int() is kept in the v6 dict under the row instead.
+    """
+
+    def __init__(self):
+        self.dirs = array("B")
+        self.ips = array("I")
+        self.ports = array("H")
+        self.flags = array("B")
+        self.lines = array("I")
+        self.v6 = {}
+
+    def __len__(self):
+        return len(self.dirs)
+
+    def append(self, direction, ip_int, port, flag, line):
+        self.dirs.append(direction)
+        self.ips.append(ip_int)
+        self.ports.append(port)
+        self.flags.append(flag)
+        self.lines.append(line)
+
+    def extend(self, other):
+        if other.v6:
+            offset = len(self.dirs)
+            self.v6.update((k + offset, ip_int) for k, ip_int in other.v6.items())
+        self.dirs.extend(other.dirs)
+        self.ips.extend(other.ips)
+        self.ports.extend(other.ports)
+        self.flags.extend(other.flags)
+        self.lines.extend(other.lines)
+
+    def packet(self, k):
+        """the packet fields of row k as strings, ip and port in canonical form"""
+        if k < 0:
+            k += len(self.dirs)
+        ip = int2ip(self.ips[k]) if k not in self.v6 else int2ip6(self.v6[k])
+        return (DIRECTIONS[self.dirs[k]], ip, str(self.ports[k]), str(self.flags[k]))
+
+
+_DIRECTION_CODES = {direction.encode(): code for code, direction in enumerate(DIRECTIONS)}
+_FLAG_CODES = {b"0": 0, b"1": 1}
+# canonical octets only, anything else takes the get_packet() path
+_OCTETS = {str(value).encode(): value for value in range(256)}
+
+
+def parse_packet_bytes(data, first_line, packets_fname, columns):
+    """
+    Parses whole lines of a packets file from data into columns.
+
+    The common case is parsed straight from bytes. Anything the fast path
+    doesn't accept goes through get_packet(), so invalid packets fail with
+    exactly the same messages, and odd but valid ones (like a '*' address)
+    are still taken, IPv6 addresses included.
+    """
+    dirs, ips, ports, flags, lines = (
+        columns.dirs, columns.ips, columns.ports, columns.flags, columns.lines)
+    octets = _OCTETS
+    i = first_line - 1
+    for line in data.splitlines():
+        i += 1
+        if b"#" in line:
+            line = line[:line.find(b"#")]
+        fields = line.split()
+        if not fields:
+            continue
+        try:
+            direction, ip, port, flag = fields
+            direction = _DIRECTION_CODES[direction]
+            a, b, c, d = ip.split(b".")
+            ip = (octets[a] << 24) | (octets[b] << 16) | (octets[c] << 8) | octets[d]
+            port = int(port)
+            flag = _FLAG_CODES[flag]
+            if not 0 <= port <= 65535:
+                raise ValueError
+        except (ValueError, KeyError):
+            packet = get_packet(line.decode("ascii"), i, packets_fname)
+            direction = DIRECTIONS.index(packet[0])
+            ip = ip2int(packet[1])
+            if ip > 0xFFFFFFFF:
+                columns.v6[len(dirs)] = ip
+                ip = 0
+            port = int(packet[2])
+            flag = int(packet[3])
+        dirs.append(direction)
+        ips.append(ip)
+        ports.append(port)
+        flags.append(flag)
+        lines.append(i)
+    return i
+
+
+def iter_packet_columns(packets_fname, chunk_size=1 << 22):
+    """
+    Memory maps the packets file and yields PacketColumns for consecutive
+    chunks of about chunk_size bytes, each cut after a line break. A pipe
+    is read in chunks like that instead. Binary packet traces are
+    recognized and read TRACE_CHUNK records at a time.
+    """
+    if is_packet_trace(packets_fname):
+        with PacketTrace(packets_fname) as trace:
+            for start in range(0, len(trace), TRACE_CHUNK):
+                yield trace.columns(start, start + TRACE_CHUNK)
+        return
+
+    with open(packets_fname, "rb") as fp:
+        line = 1
+        for chunk in _packet_chunks(fp, chunk_size):
+            columns = PacketColumns()
+            parse_packet_bytes(chunk, line, packets_fname, columns)
+            # same line breaks as text mode: \n, \r\n and a lone \r
+            line += (chunk.count(b"\n") + chunk.count(b"\r") - chunk.count(b"\r\n"))
+            yield columns
+
+
+def _packet_chunks(fp, chunk_size):
+    '''the bytes of fp in chunks of about chunk_size, each cut after a line break'''
+    st = os.fstat(fp.fileno())
+    if not stat.S_ISREG(st.st_mode):
+        # a pipe can't be mapped
+        pending = b""
+        while True:
+            data = fp.read(chunk_size)
+            if not data:
+                break
+            data = pending + data
+            end = data.rfind(b"\n") + 1
+            if end:
+                yield data[:end]
+            pending = data[end:]
+        if pending:
+            yield pending
+        return
+
+    size = st.st_size
+    if size == 0:
+        return
+    with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < size:
+            end = mm.find(b"\n", min(start + chunk_size, size) - 1)
+            end = size if end == -1 else end + 1
+            yield mm[start:end]
+            start = end
+
+
+# binary packet traces: TRACE_MAGIC, then fixed-width little-endian records
+# of direction u8, ip u32, port u16, flag u8 and source line u32
+TRACE_MAGIC = b"\x00FWPKT1\n"
+TRACE_RECORD = struct.Struct("<BIHBI")
+# records turned into PacketColumns at a time
+TRACE_CHUNK = 1 << 18
+
+
+def is_packet_trace(fname) -> bool:
+    # reading the header of a pipe would use up its packets
+    if not stat.S_ISREG(os.stat(fname).st_mode):
+        return False
+    with open(fname, "rb") as fp:
+        return fp.read(len(TRACE_MAGIC)) == TRACE_MAGIC
+
+
+class PacketTrace:
+    """
+    Memory mapped binary packet trace with random access by record index.
+
+    Records are read straight from the map with struct, without creating
+    any strings, so any range of records can be classified independently.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, "rb") as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)[len(TRACE_MAGIC):]
+        if self.mm[:len(TRACE_MAGIC)] != TRACE_MAGIC or len(self.view) % TRACE_RECORD.size:
+            self.close()
+            raise Warning(f"{fname}: not a valid packet trace")
+
+    def __len__(self):
+        return len(self.view) // TRACE_RECORD.size
+
+    def __getitem__(self, k):
+        """(direction, ip, port, flag, line) of record k"""
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError("packet trace index out of range")
+        return TRACE_RECORD.unpack_from(self.view, k * TRACE_RECORD.size)
+
+    def columns(self, start=0, stop=None) -> PacketColumns:
+        """records start up to stop as PacketColumns"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        columns = PacketColumns()
+        if start >= stop:
+            return columns
+        size = TRACE_RECORD.size
+        append = columns.append
+        for direction, ip_int, port, flag, line in TRACE_RECORD.iter_unpack(
+                self.view[start * size:stop * size]):
+            if direction >= len(DIRECTIONS) or flag > 1:
+                raise Warning(f"{self.fname}:{line}: corrupt packet record")
+            append(direction, ip_int, port, flag, line)
+        return columns
+
+    def close(self):
+        self.view.release()
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def pack_packets(packets_fname, trace_fname) -> int:
+    """
+    Converts a text packets file into a binary trace, returns the record
+    count. The trace is written to a temporary file and only replaces
+    trace_fname once complete.
+    """
+    if os.path.exists(trace_fname) and os.path.samefile(packets_fname, trace_fname):
+        raise Warning(f"{trace_fname}: the trace would overwrite the packets file")
+    tmp_fname = f"{trace_fname}.{os.getpid()}.tmp"
+    count = 0
+    try:
+        with open(tmp_fname, "wb") as fp:
+            fp.write(TRACE_MAGIC)
+            for columns in iter_packet_columns(packets_fname):
+                if columns.v6:
+                    line = columns.lines[min(columns.v6)]
+                    raise Warning(f"{packets_fname}:{line}: IPv6 packets can't be packed "
+                                  "into a packet trace")
+                records = bytearray(len(columns) * TRACE_RECORD.size)
+                for k, record in enumerate(zip(columns.dirs, columns.ips, columns.ports,
+                                               columns.flags, columns.lines)):
+                    TRACE_RECORD.pack_into(records, k * TRACE_RECORD.size, *record)
+                fp.write(records)
+                count += len(columns)
+        os.replace(tmp_fname, trace_fname)
+    except BaseException:
+        # don't leave a truncated trace behind
+        if os.path.exists(tmp_fname):
+            os.unlink(tmp_fname)
+        raise
+    return count
+
+
+def load_packets(packets_fname) -> PacketColumns:
+    """parses the whole packets file into one PacketColumns"""
+    columns = PacketColumns()
+    for chunk in iter_packet_columns(packets_fname):
+        columns.extend(chunk)
+    return columns
+
+
+class FlowDedup:
+    """
+    Makes decide_columns() decide every distinct (direction, ip, port, flag)
+    of a batch only once, see dedup_columns(). Counts packets and distinct
+    flows over all batches.
+    """
+
+    def __init__(self):
+        self.packets = 0
+        self.unique = 0
+
+    @property
+    def ratio(self) -> float:
+        '''packets per distinct flow'''
+        return self.packets / self.unique if self.unique else 0.0
+
+
+def dedup_columns(columns):
+    """
+    Collapses columns into its distinct (direction, ip, port, flag) keys.
+    Returns them as PacketColumns (with line 0) and, for every row of
+    columns, the index of its key. Uses numpy.unique() when available.
+    """
+    unique = PacketColumns()
+    if not load_numpy():
+        index = {}
+        inverse = [index.setdefault(key, len(index))
+                   for key in zip(columns.dirs, columns.ips, columns.ports, columns.flags)]
+        for direction, ip_int, port, flag in index:
+            unique.append(direction, ip_int, port, flag, 0)
+        return unique, inverse
+
+    # one uint64 per packet: direction, flag, ip and port bits side by side
+    u64 = np.uint64
+    keys = ((np.frombuffer(columns.dirs, np.uint8).astype(u64) << u64(49))
+            | (np.frombuffer(columns.flags, np.uint8).astype(u64) << u64(48))
+            | (np.frombuffer(columns.ips, np.uint32).astype(u64) << u64(16))
+            | np.frombuffer(columns.ports, np.uint16).astype(u64))
+    keys, inverse = np.unique(keys, return_inverse=True)
+    unique.dirs.frombytes((keys >> u64(49)).astype(np.uint8).tobytes())
+    unique.flags.frombytes(((keys >> u64(48)) & u64(1)).astype(np.uint8).tobytes())
+    unique.ips.frombytes(((keys >> u64(16)) & u64(0xFFFFFFFF)).astype(np.uint32).tobytes())
+    unique.ports.frombytes((keys & u64(0xFFFF)).astype(np.uint16).tobytes())
+    unique.lines.frombytes(bytes(4 * len(keys)))
+    return unique, inverse.tolist()
+
+
+def decide_columns(matcher, columns, cache=None, flows=None, dedup=None):
+    """
+    Returns the deciding Rule (or None) for every row of columns. With a
+    FlowDedup as dedup each distinct packet is decided once and the results
+    are scattered back; not with flows, which need every packet in order.
+    IPv6 rows are decided afterwards by the IPv6 index in matcher.v6.
+    """
+    decided = _decide_rows(matcher, columns, cache, flows, dedup)
+    if columns.v6:
+        lookup = getattr(matcher, "v6", matcher).lookup
+        dirs, ports, flags = columns.dirs, columns.ports, columns.flags
+        for k, ip_int in columns.v6.items():
+            decided[k] = lookup(DIRECTIONS[dirs[k]], ip_int, ports[k], flags[k] == 1)
+    return decided
+
+
+def _decide_rows(matcher, columns, cache, flows, dedup):
+    if dedup is not None and flows is None:
+        unique, inverse = dedup_columns(columns)
+        dedup.packets += len(columns)
+        dedup.unique += len(unique)
+        decided = _decide_rows(matcher, unique, cache, None, None)
+        return [decided[k] for k in inverse]
+
+    if hasattr(matcher, "lookup_columns") and flows is None:
+        return matcher.lookup_columns(columns)
+
+    if cache is None:
+        cache = DecisionCache()
+    if cache.size > 0:
+        # keep what earlier chunks cached for the same matcher
+        if cache.matcher is not matcher:
+            cache.bind(matcher)
+        matcher = cache
+    if flows is not None:
+        # flows stay open across chunks too
+        if flows.matcher is not matcher:
+            flows.bind(matcher)
+        matcher = flows
+
+    lookup = matcher.lookup
+    rows = zip(columns.dirs, columns.ips, columns.ports, columns.flags)
+    if columns.v6:
+        # the placeholder rows of IPv6 packets stay out of cache and flows
+        v6 = columns.v6
+        return [lookup(DIRECTIONS[d], ip, port, flag == 1) if k not in v6 else None
+                for k, (d, ip, port, flag) in enumerate(rows)]
+    return [lookup(DIRECTIONS[d], ip, port, flag == 1) for d, ip, port, flag in rows]
+
+
+def classify_columns(matcher, columns, cache=None, flows=None, dedup=None):
+    """yields the result tuple of every row of columns"""
+    for k, rule in enumerate(decide_columns(matcher, columns, cache, flows, dedup)):
+        yield result_tuple(rule, columns.packet(k))
+
+
+# action codes of ResultColumns, 0 is the default policy
+ACTIONS = ("default", "accept", "drop", "deny")
+_ACTION_CODES = {action: code for code, action in enumerate(ACTIONS)}
+
+
+class ResultColumns(Sequence):
+    """
+    Results as typed arrays: an action code (index into ACTIONS) and the
+    rule line (0 for default) per packet, next to the packets themselves
+    as PacketColumns. Behaves like the list fwsim() returns, but the
+    (action, rule_line, direction, ip, port, flag) string tuples are only
+    made for the rows indexed or iterated. write() formats the output
+    straight from the arrays.
+    """
+
+    def __init__(self, actions=None, rule_lines=None, packets=None):
+        self.actions = actions if actions is not None else array("B")
+        self.rule_lines = rule_lines if rule_lines is not None else array("I")
+        self.packets = packets if packets is not None else PacketColumns()
+
+    def __len__(self):
+        return len(self.actions)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[i] for i in range(*k.indices(len(self)))]
+        if k < 0:
+            k += len(self)
+        action = self.actions[k]
+        rule_line = str(self.rule_lines[k]) if action else ""
+        return (ACTIONS[action], rule_line) + self.packets.packet(k)
+
+    def __iter__(self):
+        packets = self.packets
+        heads = {}  # (action, rule_line) strings, the same for every packet of a rule
+        ips = map(int2ip, packets.ips)
+        if packets.v6:
+            v6 = packets.v6
+            ips = (int2ip6(v6[k]) if k in v6 else ip for k, ip in enumerate(ips))
+        for action, rule_line, d, ip, port, flag in zip(
+                self.actions, self.rule_lines, packets.dirs, ips, packets.ports, packets.flags):
+            head = heads.get((action, rule_line))
+            if head is None:
+                head = heads[action, rule_line] = (ACTIONS[action],
+                                                   str(rule_line) if action else "")
+            yield head + (DIRECTIONS[d], ip, str(port), str(flag))
+
+    def append_decided(self, decided, columns):
+        """adds the rows of columns with their deciding rules (None for default)"""
+        actions, rule_lines = decision_arrays(decided)
+        self.actions.extend(actions)
+        self.rule_lines.extend(rule_lines)
+        self.packets.extend(columns)
+
+    def extend(self, other):
+        self.actions.extend(other.actions)
+        self.rule_lines.extend(other.rule_lines)
+        self.packets.extend(other.packets)
+
+    def format_lines(self, start=0, stop=None) -> str:
+        """rows start to stop formatted like fw.py, one joined string"""
+        packets = self.packets
+        rows = slice(start, stop)
+        prefixes = {}  # formatting is the same for every packet of a rule
+        directions = [f"{direction:3}" for direction in DIRECTIONS]
+        ips = map(int2ip, packets.ips[rows])
+        v6 = packets.v6
+        if v6:
+            ips = [int2ip6(v6[k]) if k in v6 else ip
+                   for k, ip in enumerate(ips, rows.indices(len(self))[0])]
+        out = []
+        for action, rule_line, d, ip, port, flag in zip(
+                self.actions[rows], self.rule_lines[rows], packets.dirs[rows],
+                ips, packets.ports[rows], packets.flags[rows]):
+            prefix = prefixes.get((action, rule_line))
+            if prefix is None:
+                prefix = f"{ACTIONS[action]}({rule_line if action else ''})"
+                prefix = prefixes[action, rule_line] = f"{prefix:12}"
+            out.append(f"{prefix} {directions[d]} {ip:15} {port:<5} {flag}\n")
+        return "".join(out)
+
+    def write(self, fp, chunk_size=65536):
+        """writes every row to the text file fp, chunk_size rows per write"""
+        for start in range(0, len(self), chunk_size):
+            fp.write(self.format_lines(start, start + chunk_size))
+
+
+def decision_arrays(decided):
+    """action codes and rule lines (0 for default) of the deciding rules"""
+    codes = _ACTION_CODES
+    return (array("B", [codes[rule.action] if rule is not None else 0 for rule in decided]),
+            array("I", [rule.line if rule is not None else 0 for rule in decided]))
+
+
+def verdict_differences(results) -> list[int]:
+    """rows where the actions of ResultColumns over the same packets differ"""
+    return [k for k, actions in enumerate(zip(*(r.actions for r in results)))
+            if min(actions) != max(actions)]
+
+
+def decide_results(matcher, columns, cache=None, flows=None, dedup=None) -> ResultColumns:
+    """decide_columns() for columns, returned as ResultColumns"""
+    results = ResultColumns()
+    results.append_decided(decide_columns(matcher, columns, cache, flows, dedup), columns)
+    return results
+
+
+# bump when the layout of compiled rules or matchers changes
+RULES_CACHE_VERSION = 3
+RULES_CACHE_MAGIC = b"FWSIMRC\n"
+
+
+def rules_cache_fname(rules_fname, variant):
+    head, tail = os.path.split(rules_fname)
+    return os.path.join(head, f".{tail}.{variant}.fwcache")
+
+
+@cache
+def source_digest() -> str:
+    '''SHA-256 of this file, any change to how engines are built makes old caches stale'''
+    with open(__file__, "rb") as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+
+def rules_cache_key(data, st, variant) -> dict:
+    """key of the rules file bytes data, with st its os.stat_result"""
+    digest = hashlib.sha256(data).hexdigest()
+    return {
+        "version": RULES_CACHE_VERSION,
+        "source": source_digest(),
+        "python": list(sys.version_info[:2]),
+        "variant": variant,
+        "size": st.st_size,
+        "mtime": st.st_mtime_ns,
+        "sha256": digest,
+    }
+
+
+def load_rules_cache(cache_fname, key):
+    """returns the cached matcher, or None if it is missing, stale or corrupt"""
+    try:
+        # only trust caches nobody else could have written
+        st = os.stat(cache_fname)
+        if hasattr(os, "getuid") and (st.st_uid != os.getuid() or st.st_mode & 0o022):
+            return None
+
+        with open(cache_fname, "rb") as fp:
+            data = fp.read()
+        if not data.startswith(RULES_CACHE_MAGIC):
+            return None
+        start = len(RULES_CACHE_MAGIC) + 4
+        key_len = int.from_bytes(data[start - 4:start], "little")
+        if json.loads(data[start:start + key_len]) != key:
+            return None
+        # the collector would keep rescanning the many new objects for cycles
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return pickle.loads(memoryview(data)[start + key_len:])
+        finally:
+            if gc_enabled:
+                gc.enable()
+    except Exception:
+        # anything wrong with the cache just means compiling again
+        return None
+
+
+def save_rules_cache(cache_fname, key, matcher):
+    """writes the cache atomically, silently gives up if that's not possible"""
+    tmp_fname = f"{cache_fname}.{os.getpid()}.tmp"
+    try:
+        key = json.dumps(key).encode()
+        payload = pickle.dumps(matcher, pickle.HIGHEST_PROTOCOL)
+        fd = os.open(tmp_fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "wb") as fp:
+            fp.write(RULES_CACHE_MAGIC + len(key).to_bytes(4, "little") + key + payload)
+        os.replace(tmp_fname, cache_fname)
+    except Exception:
+        # matchers of registered engines may not pickle at all
+        try:
+            os.unlink(tmp_fname)
+        except OSError:
+            pass
+
+
+def build_matcher(rules, engine=None, optimize=False):
+    """
+    Builds the engine's matcher over rules (see resolve_engine() for the
+    default). With optimize it only gets the rules left by optimize_rules();
+    the full list stays in .policy.
+
+    Engines only see the IPv4 and '*' rules. The IPv6 and '*' ones go into
+    a Prefix6Trie in .v6, which the generic code hands IPv6 packets to.
+    """
+    engine = resolve_engine(engine)
+    indexed = rules if not optimize else optimize_rules(rules, optimize == "redundant")
+    matcher = ENGINES[engine]([rule for rule in indexed if rule.family != 6])
+    matcher.v6 = Prefix6Trie([rule for rule in indexed if rule.family != 4])
+    matcher.policy = rules
+    return matcher
+
+
+def compile_rules(rules_fname, engine=None, rules_cache=True, optimize=False, shadow=0.0):
+    """
+    Returns the matcher for rules_fname built by engine, see build_matcher()
+    for engine and optimize (True, or "redundant" to drop redundant rules as
+    well). A shadow rate above 0 wraps it in a ShadowMatcher.
+
+    With rules_cache the compiled matcher is kept in a hidden cache file next
+    to the rules, keyed by size, mtime and SHA-256 of the rules file, and
+    loaded from there with a single read as long as the key still matches.
+    The rules file is read once, so it can be a pipe; only regular files
+    get a cache.
+    """
+    engine = resolve_engine(engine)
+    with open(rules_fname, "rb") as fp:
+        data = fp.read()
+        st = os.fstat(fp.fileno())
+    if not rules_cache or not stat.S_ISREG(st.st_mode):
+        matcher = build_matcher(parse_rules(data, rules_fname), engine, optimize)
+    else:
+        variant = engine
+        if optimize:
+            variant += ".redundant" if optimize == "redundant" else ".opt"
+        key = rules_cache_key(data, st, variant)
+        cache_fname = rules_cache_fname(rules_fname, variant)
+        matcher = load_rules_cache(cache_fname, key)
+        if matcher is None:
+            matcher = build_matcher(parse_rules(data, rules_fname), engine, optimize)
+            save_rules_cache(cache_fname, key, matcher)
+    if shadow:
+        # dropping redundant rules changes the rule lines reported, not the actions
+        matcher = ShadowMatcher(matcher, shadow, actions_only=optimize == "redundant")
+    return matcher
+
+
+# matcher compiled by the parent, set once in every worker process
+_worker_matcher = None
+
+
+def _init_worker(matcher):
+    global _worker_matcher
+    _worker_matcher = matcher
+
+
+# rule sets of fwsim_multi(), with a decision cache each, per worker process
+_worker_matchers = None
+_worker_caches = None
+
+
+def _init_multi_worker(matchers):
+    global _worker_matchers, _worker_caches
+    _worker_matchers = matchers
+    _worker_caches = [DecisionCache() for _ in matchers]
+
+
+def _decide_ruleset(k, columns):
+    return decision_arrays(decide_columns(_worker_matchers[k], columns, _worker_caches[k]))
+
+
+def _read_shard(fname, start, end):
+    with open(fname, "rb") as fp:
+        fp.seek(start)
+        return fp.read(end - start)
+
+
+def _count_shard_lines(fname, start, end):
+    # same line breaks as text mode: \n, \r\n and a lone \r
+    data = _read_shard(fname, start, end)
+    lines = data.count(b"\n") + data.count(b"\r") - data.count(b"\r\n")
+    if data and data[-1:] not in (b"\n", b"\r"):
+        lines += 1  # last line without a line break
+    return lines
+
+
+def _classify_shard(fname, start, end, first_line, bulk, columnar):
+    try:
+        if bulk or columnar:
+            columns = PacketColumns()
+            parse_packet_bytes(_read_shard(fname, start, end), first_line, fname, columns)
+            if columnar:
+                return decide_results(_worker_matcher, columns)
+            return list(classify_columns(_worker_matcher, columns))
+        fp = io.TextIOWrapper(io.BytesIO(_read_shard(fname, start, end)), encoding="ascii")
+        packets = (get_packet(l, i, fname) for i, l in iter_lines(fp, first_line))
+        return list(classify(_worker_matcher, packets))
+    except KeyboardInterrupt:
+        raise Warning(f"Program killed")
+
+
+def _classify_trace_shard(fname, start, stop, columnar):
+    try:
+        with PacketTrace(fname) as trace:
+            columns = trace.columns(start, stop)
+            if columnar:
+                return decide_results(_worker_matcher, columns)
+            return list(classify_columns(_worker_matcher, columns))
+    except KeyboardInterrupt:
+        raise Warning(f"Program killed")
 
-            # no match then use default
-            if not match:
-                results.append(
-                    ("default", "", packet[0], packet[1], packet[2], packet[3]))
+
+def shard_offsets(fname, shards):
+    """splits fname into at most shards byte ranges, each starting at a line"""
+    size = os.path.getsize(fname)
+    step = max(size // max(shards, 1), 1)
+    offsets = [0]
+    with open(fname, "rb") as fp:
+        while offsets[-1] + step < size:
+            fp.seek(offsets[-1] + step)
+            fp.readline()
+            if fp.tell() >= size:
+                break
+            offsets.append(fp.tell())
+    offsets.append(size)
+    return list(zip(offsets, offsets[1:]))
+
+
+def _run_shards(pool, tasks, jobs):
+    # keep a bounded number of shards in flight so results don't pile up
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.submit(*task))
+        if len(pending) >= jobs * 2:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _parallel_shards(matcher, packets_fname, jobs, bulk, columnar=False):
+    """
+    Results of every shard of packets_fname in order, classified by matcher
+    in jobs worker processes: a list of result tuples per shard, or with
+    columnar (which implies bulk) ResultColumns.
+
+    The parent unpickles ResultColumns in a fraction of the time a list of
+    tuples takes, but making the tuples from them again here costs more
+    than unpickling them, so only callers that keep the arrays get them.
+    """
+    # imported here, single job runs shouldn't pay for it
+    from concurrent.futures import ProcessPoolExecutor
+
+    if not stat.S_ISREG(os.stat(packets_fname).st_mode):
+        raise Warning(f"{packets_fname}: several jobs need a regular packets file")
+    pool = ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(matcher,))
+    try:
+        if is_packet_trace(packets_fname):
+            with PacketTrace(packets_fname) as trace:
+                records = len(trace)
+            step = max(-(-records // (jobs * 4)), 1)
+            tasks = [(_classify_trace_shard, packets_fname, start, start + step, columnar)
+                     for start in range(0, records, step)]
+        else:
+            shards = shard_offsets(packets_fname, jobs * 4)
+            counts = pool.map(_count_shard_lines,
+                              *zip(*((packets_fname, s, e) for s, e in shards)))
+            tasks = [(_classify_shard, packets_fname, start, end, first_line, bulk, columnar)
+                     for (start, end), first_line
+                     in zip(shards, accumulate(counts, initial=1))]
+        yield from _run_shards(pool, tasks, jobs)
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def fwsim_parallel(rules_fname: str, packets_fname: str, jobs=0, engine=None,
+                   rules_cache=True, bulk=False, stats=None, optimize=False, shadow=0.0):
+    """
+    Classifies packets in jobs worker processes (0 means one per core).
+
+    The rules are compiled once here and handed to every worker. The packets
+    file is cut into byte ranges aligned to line boundaries; the workers
+    first count the lines of every shard so each shard knows its global
+    starting line for error messages, then classify their shards. Results
+    are yielded in the original packet order. bulk, stats, optimize and
+    shadow are as for fwsim_iter(). Binary packet traces are sharded by
+    record index instead. fwsim_parallel_chunks() gets ResultColumns from
+    the workers instead of result tuples.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    try:
+        matcher = compile_rules(rules_fname, engine, rules_cache, optimize, shadow)
+        results = (result for shard in _parallel_shards(matcher, packets_fname, jobs, bulk)
+                   for result in shard)
+        if stats is not None:
+            stats.bind(matcher.policy)
+            results = stats.collect(results)
+        yield from results
+
+    except (IOError, FileNotFoundError) as e:
+        raise Warning(f"Error opening file: {str(e)}")
+    except KeyboardInterrupt:
+        raise Warning(f"Program killed")
+
+
+def fwsim_parallel_chunks(rules_fname: str, packets_fname: str, jobs=0, engine=None,
+                          rules_cache=True, optimize=False, shadow=0.0):
+    """
+    fwsim_parallel() in bulk mode, yielding the ResultColumns of every shard
+    in order instead of result tuples.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    try:
+        matcher = compile_rules(rules_fname, engine, rules_cache, optimize, shadow)
+        yield from _parallel_shards(matcher, packets_fname, jobs, True, columnar=True)
+
+    except (IOError, FileNotFoundError) as e:
+        raise Warning(f"Error opening file: {str(e)}")
+    except KeyboardInterrupt:
+        raise Warning(f"Program killed")
+
+
+def fwsim_iter(rules_fname: str, packets_fname: str, cache=None, engine=None, jobs=1,
+               matcher=None, rules_cache=True, bulk=False, stats=None, optimize=False,
+               flows=None, dedup=None, shadow=0.0):
+    """
+    Streaming version of fwsim().
+
+    The rules are loaded up front, then packets are read lazily and each
+    (action, rule_line, direction, ip, port, flag) tuple is yielded as soon
+    as it is decided, so memory use does not grow with the packets file.
+
+    engine picks the matcher from ENGINES (default from resolve_engine()),
+    see classify() for cache and flows and compile_rules() for rules_cache,
+    optimize and shadow, the reference cross-check rate. An already
+    compiled matcher can be passed instead. With jobs other than 1 the work
+    is spread over processes by fwsim_parallel(); connection tracking needs
+    the packets in order, so flows only works with a single job.
+
+    With bulk the packets file is memory mapped and parsed in chunks straight
+    into PacketColumns, which is much faster, but addresses and ports come
+    back in canonical form (e.g. '010.0.0.1' is reported as '10.0.0.1').
+    Binary packet traces (see pack_packets()) are always read that way.
+
+    Pass a RuleStats as stats to collect per rule statistics; without it
+    no counting is done at all. A FlowDedup as dedup decides each distinct
+    packet of a chunk once (see decide_columns()) and implies bulk; it also
+    needs a single job.
+    """
+    if jobs != 1:
+        if flows is not None:
+            raise Warning("connection tracking needs a single job")
+        if dedup is not None:
+            raise Warning("flow deduplication needs a single job")
+        yield from fwsim_parallel(rules_fname, packets_fname, jobs, engine,
+                                  rules_cache, bulk, stats, optimize, shadow)
+        return
+
+    try:
+        if matcher is None:
+            matcher = compile_rules(rules_fname, engine, rules_cache, optimize, shadow)
+        if bulk or dedup is not None or is_packet_trace(packets_fname):
+            if cache is None:
+                cache = DecisionCache()
+            results = (result for columns in iter_packet_columns(packets_fname)
+                       for result in classify_columns(matcher, columns, cache, flows, dedup))
+        else:
+            results = classify(matcher, read_packets(packets_fname), cache, flows)
+
+        if stats is not None:
+            stats.bind(getattr(matcher, "policy", matcher.rules))
+            results = stats.collect(results)
+        yield from results
+
+    except (IOError, FileNotFoundError) as e:
+        raise Warning(f"Error opening file: {str(e)}")
+    except KeyboardInterrupt:
+        raise Warning(f"Program killed")
+
+
+def fwsim_chunks(rules_fname: str, packets_fname: str, cache=None, engine=None,
+                 matcher=None, rules_cache=True, optimize=False, flows=None, dedup=None,
+                 shadow=0.0, jobs=1):
+    """
+    Yields the results as ResultColumns, one per chunk of the packets file
+    read like fwsim_iter() does with bulk. The options are as for
+    fwsim_iter(); with jobs other than 1 the chunks are the shards of
+    fwsim_parallel_chunks().
+    """
+    if jobs != 1:
+        if flows is not None:
+            raise Warning("connection tracking needs a single job")
+        if dedup is not None:
+            raise Warning("flow deduplication needs a single job")
+        yield from fwsim_parallel_chunks(rules_fname, packets_fname, jobs, engine,
+                                         rules_cache, optimize, shadow)
+        return
+
+    try:
+        if matcher is None:
+            matcher = compile_rules(rules_fname, engine, rules_cache, optimize, shadow)
+        if cache is None:
+            cache = DecisionCache()
+        for columns in iter_packet_columns(packets_fname):
+            yield decide_results(matcher, columns, cache, flows, dedup)
+
+    except (IOError, FileNotFoundError) as e:
+        raise Warning(f"Error opening file: {str(e)}")
+    except KeyboardInterrupt:
+        raise Warning(f"Program killed")
+
+
+def fwsim_multi(rules_fnames, packets_fname: str, engine=None, jobs=0,
+                rules_cache=True, optimize=False):
+    """
+    Classifies one packets file against several rule sets in one pass.
+
+    The packets are read and parsed only once, chunk by chunk as fwsim_iter()
+    does with bulk, and every chunk is decided against each rule set. Yields
+    per chunk a list with one ResultColumns per rules file, all sharing the
+    chunk's PacketColumns.
+
+    With jobs other than 1 (0 means one per core) the rule sets are decided
+    in up to one worker process each while the next chunks are parsed here.
+    engine, rules_cache and optimize are as for compile_rules().
+    """
+    try:
+        matchers = [compile_rules(fname, engine, rules_cache, optimize)
+                    for fname in rules_fnames]
+        jobs = min(jobs or os.cpu_count() or 1, len(matchers))
+        if jobs <= 1:
+            caches = [DecisionCache() for _ in matchers]
+            for columns in iter_packet_columns(packets_fname):
+                yield [decide_results(matcher, columns, cache)
+                       for matcher, cache in zip(matchers, caches)]
+            return
+
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(jobs, initializer=_init_multi_worker,
+                                   initargs=(matchers,))
+        try:
+            pending = deque()
+            for columns in iter_packet_columns(packets_fname):
+                pending.append((columns, [pool.submit(_decide_ruleset, k, columns)
+                                          for k in range(len(matchers))]))
+                if len(pending) >= 2:
+                    columns, futures = pending.popleft()
+                    yield [ResultColumns(*f.result(), columns) for f in futures]
+            while pending:
+                columns, futures = pending.popleft()
+                yield [ResultColumns(*f.result(), columns) for f in futures]
+        finally:
+            pool.shutdown(cancel_futures=True)
 
     except (IOError, FileNotFoundError) as e:
         raise Warning(f"Error opening file: {str(e)}")
     except KeyboardInterrupt:
         raise Warning(f"Program killed")
 
-    return results
\ No newline at end of file
+
+def fwsim(rules_fname: str, packets_fname: str, columnar=False, **options) -> list[list[str]]:
+    """
+    This function implements the firewall simulator.
+
+    Returns a list of tuples, where each tuple represents the result of 
+    matching the packet to a rule. For each packet, it inserts a tuple
+        (action, rule_line, direction, ip, port, flag)
+    into the result. 
+
+    Keyword options are passed on to fwsim_iter(). With columnar the
+    packets are parsed in bulk and a ResultColumns is returned instead of
+    the list, which takes a fraction of the memory; options then go to
+    fwsim_chunks().
+    """
+    if columnar:
+        results = ResultColumns()
+        for chunk in fwsim_chunks(rules_fname, packets_fname, **options):
+            results.extend(chunk)
+        return results
+    return list(fwsim_iter(rules_fname, packets_fname, **options))
+
+
+def format_result(result) -> str:
+    '''format one tuple as a string, same as fw.py'''
+    action, rule_line, direction, ip, port, flag = [str(r) for r in result]
+    prefix = f"{action}({rule_line})"
+    suffix = f"{direction:3} {ip:15} {port:5} {flag}"
+    return f"{prefix:12} {suffix}"
+
+
+def parse_args():
+    '''parse command lines'''
+    parser = argparse.ArgumentParser(
+        prog='fwsim',
+        description='streaming firewall simulator, prints results as they are decided',
+    )
+    parser.add_argument('rulesfname', help='filename with firewall rules')
+    parser.add_argument('packetsfname', help='filename with packets')
+    parser.add_argument('--engine', choices=ENGINES,
+                        help=f'rule matching engine (default: $FWSIM_ENGINE or {DEFAULT_ENGINE})')
+    parser.add_argument('--shadow', type=float, default=0.0, metavar='RATE',
+                        help='check this fraction of decisions against the reference matcher '
+                             'and stop on a mismatch')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='worker processes, 0 for one per core (default: 1)')
+    parser.add_argument('--bulk', action='store_true',
+                        help='parse packets in bulk from a memory map (canonical ip/port output)')
+    parser.add_argument('--stats', metavar='FILE',
+                        help="write per rule hit statistics as JSON to FILE ('-' for stderr)")
+    parser.add_argument('--optimize', action='store_true',
+                        help='leave shadowed rules out of the compiled engine')
+    parser.add_argument('--drop-redundant', action='store_true',
+                        help='with --optimize also leave out redundant rules '
+                             '(same actions, but may report a later rule line)')
+    parser.add_argument('--shadow-report', metavar='FILE',
+                        help="write the shadowed/redundant rules as JSON to FILE ('-' for stderr)")
+    parser.add_argument('--flows', action='store_true',
+                        help='stateful mode: answer established packets of accepted flows '
+                             'from a flow table')
+    parser.add_argument('--flow-size', type=int, default=65536,
+                        help='most open flows in the flow table (default: 65536)')
+    parser.add_argument('--flow-idle', type=int, default=1000000,
+                        help='packets after which an idle flow is closed (default: 1000000)')
+    parser.add_argument('--flow-stats', action='store_true',
+                        help='print flow table hits/misses to stderr')
+    parser.add_argument('--verify-flows', action='store_true',
+                        help='also look up every flow table answer statelessly and '
+                             'count the differences')
+    parser.add_argument('--dedup', action='store_true',
+                        help='decide each distinct packet of a chunk once (implies --bulk)')
+    parser.add_argument('--dedup-stats', action='store_true',
+                        help='print packets per distinct packet of --dedup to stderr')
+    parser.add_argument('--dump-code', metavar='FILE',
+                        help="write the Python source the codegen engine generates for the "
+                             "rules to FILE ('-' for stderr)")
+    parser.add_argument('--no-rules-cache', dest='rules_cache', action='store_false',
+                        help="don't read or write the compiled rules cache file")
+    parser.add_argument('--cache-size', type=int, default=4096,
+                        help='entries in the decision cache, 0 disables it')
+    parser.add_argument('--cache-stats', action='store_true',
+                        help='print decision cache hits/misses to stderr')
+    parser.add_argument('--index-stats', action='store_true',
+                        help='print the rule index statistics of the engine to stderr as JSON')
+    return parser.parse_args()
+
+
+def write_text(fname, text):
+    '''writes text to fname, '-' means stderr'''
+    if fname == "-":
+        print(text, file=sys.stderr)
+    else:
+        with open(fname, "w") as fp:
+            fp.write(text + "\n")
+
+
+def write_report(fname, data):
+    '''writes data as JSON to fname, '-' means stderr'''
+    write_text(fname, json.dumps(data, indent=2))
+
+
+def main():
+    '''entry point, same output as fw.py but written incrementally'''
+    args = parse_args()
+    out = sys.stdout
+    cache = DecisionCache(args.cache_size)
+    stats = RuleStats() if args.stats else None
+    flows = FlowTable(args.flow_size, args.flow_idle, args.verify_flows) if args.flows else None
+    dedup = FlowDedup() if args.dedup else None
+    optimize = args.optimize and ("redundant" if args.drop_redundant else True)
+    try:
+        matcher = None
+        if args.jobs == 1:
+            matcher = compile_rules(args.rulesfname, args.engine, args.rules_cache, optimize,
+                                    args.shadow)
+        if args.shadow_report:
+            # the rules may come from a pipe, so don't read them twice
+            rules = matcher.policy if matcher is not None else read_rules(args.rulesfname)
+            write_report(args.shadow_report, analyze_rules(rules))
+        if args.dump_code:
+            rules = matcher.rules if matcher is not None else read_rules(args.rulesfname)
+            source = getattr(matcher, "source", None) or generate_source(rules)
+            write_text(args.dump_code, source.rstrip("\n"))
+        bulk = args.bulk or args.dedup or is_packet_trace(args.packetsfname)
+        if bulk and not stats:
+            # format whole chunks straight from the result arrays
+            for chunk in fwsim_chunks(args.rulesfname, args.packetsfname, cache,
+                                      args.engine, matcher, args.rules_cache, optimize,
+                                      flows, dedup, args.shadow, args.jobs):
+                chunk.write(out)
+        else:
+            for result in fwsim_iter(args.rulesfname, args.packetsfname, cache,
+                                     args.engine, args.jobs, matcher, args.rules_cache,
+                                     args.bulk, stats, optimize, flows, dedup, args.shadow):
+                out.write(format_result(result) + "\n")
+        out.flush()
+        if stats is not None:
+            write_report(args.stats, stats.as_dict())
+        if args.cache_stats:
+            print(f"cache: {cache.hits} hits, {cache.misses} misses, "
+                  f"{cache.hit_rate:.1%} hit rate", file=sys.stderr)
+        if dedup is not None and args.dedup_stats:
+            print(f"dedup: {dedup.packets} packets, {dedup.unique} distinct, "
+                  f"{dedup.ratio:.1f} packets each", file=sys.stderr)
+        if flows is not None and args.flow_stats:
+            print(f"flows: {flows.hits} hits, {flows.misses} misses, "
+                  f"{flows.hit_rate:.1%} hit rate, {flows.evictions} closed"
+                  + (f", {flows.mismatches} mismatches" if flows.verify else ""),
+                  file=sys.stderr)
+        if isinstance(matcher, ShadowMatcher):
+            print(f"shadow: {matcher.checked} decisions matched the reference",
+                  file=sys.stderr)
+        if args.index_stats and hasattr(matcher, "stats"):
+            print(json.dumps(matcher.stats(), indent=2), file=sys.stderr)
+    except BrokenPipeError:
+        # reader went away, e.g. piped into head
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    except (IOError, FileNotFoundError) as e:
+        print(f"Simulator error: Error opening file: {str(e)}")
+    except Warning as e:
+        out.flush()
+        print(f"Simulator error: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+#!/bin/env python3
+# Long running firewall simulator. Keeps the compiled rules in memory and
+# classifies packet lines sent over a Unix domain socket or stdin, answering
+# in the same format as fw.py, so batches don't pay for interpreter startup
+# and rule compilation every time. Changes to the rules file are picked up
+# in the background while packets keep being answered.
+
+import argparse
+import os
+import signal
+import socketserver
+import stat
+import sys
+import threading
+import time
+
+import fwsim
+
+READ_SIZE = 1 << 16
+
+
+class DirectionMatcher:
+    """
+    Engine with a separate index per direction, so a change of the rules
+    only rebuilds the directions it touches. indexes maps each direction to
+    (key of its rules, matcher). Never changed once built; a reload makes a
+    new one. IPv6 packets go to the IPv6 index of their direction.
+    """
+
+    def __init__(self, rules, indexes):
+        self.rules = rules
+        self.indexes = indexes
+
+    def lookup(self, direction, ip_int, port, established):
+        matcher = self.indexes[direction][1]
+        if ip_int > 0xFFFFFFFF:
+            matcher = matcher.v6
+        return matcher.lookup(direction, ip_int, port, established)
+
+
+def rules_key(rules) -> tuple:
+    '''what an index depends on: the text and line of every rule'''
+    return tuple((rule.line, tuple(rule.fields)) for rule in rules)
+
+
+class RuleServer:
+    """
+    Holds the current DirectionMatcher for rules_fname in .matcher.
+
+    reload() builds the replacement completely before swapping it in with a
+    single assignment, so whoever took .matcher keeps a consistent rule set
+    for as long as they use it. watch() polls the rules file and reloads
+    whenever it changes.
+    """
+
+    def __init__(self, rules_fname, engine=None, interval=1.0):
+        self.rules_fname = rules_fname
+        self.engine = fwsim.resolve_engine(engine)
+        self.interval = interval
+        self.matcher = None
+        self.reloads = 0
+        self._stamp = None
+        self.reload()
+
+    def _file_stamp(self):
+        st = os.stat(self.rules_fname)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def reload(self) -> list[str]:
+        """
+        Reads the rules again and swaps in a matcher with rebuilt indexes
+        for the directions whose rules changed. Returns those directions.
+        On an invalid rules file the current matcher stays in place.
+        """
+        # taken first, so a file changing while it is read is reloaded again
+        self._stamp = self._file_stamp()
+        rules = fwsim.read_rules(self.rules_fname)
+        old = self.matcher.indexes if self.matcher is not None else {}
+
+        indexes = {}
+        for direction in fwsim.DIRECTIONS:
+            subset = [rule for rule in rules if rule.direction == direction]
+            key = rules_key(subset)
+            if direction in old and old[direction][0] == key:
+                indexes[direction] = old[direction]
+            else:
+                indexes[direction] = (key, fwsim.build_matcher(subset, self.engine))
+
+        self.matcher = DirectionMatcher(rules, indexes)
+        self.reloads += 1
+        return [d for d in fwsim.DIRECTIONS if indexes[d] is not old.get(d)]
+
+    def watch(self):
+        '''polls the rules file every interval seconds, meant for a thread'''
+        while True:
+            time.sleep(self.interval)
+            try:
+                if self._file_stamp() == self._stamp:
+                    continue
+                changed = self.reload()
+                print(f"{self.rules_fname} reloaded, rebuilt: {', '.join(changed) or 'nothing'}",
+                      file=sys.stderr)
+            except (IOError, FileNotFoundError) as e:
+                print(f"Simulator error: Error opening file: {str(e)}", file=sys.stderr)
+            except Warning as e:
+                print(f"Simulator error: {e}, keeping the previous rules", file=sys.stderr)
+
+
+def answer(matcher, data, first_line, name, cache):
+    """
+    Classifies the whole packet lines in data against matcher. Returns the
+    output for all of them and the line number after the last one.
+
+    A batch is parsed and decided in bulk. One with an invalid line is done
+    again line by line, so every good packet is still answered and each bad
+    one gets its error message in place.
+    """
+    columns = fwsim.PacketColumns()
+    try:
+        last = fwsim.parse_packet_bytes(data, first_line, name, columns)
+        out = [fwsim.format_result(result)
+               for result in fwsim.classify_columns(matcher, columns, cache)]
+    except Warning:
+        out = []
+        last = first_line - 1
+        for last, line in enumerate(data.splitlines(), first_line):
+            columns = fwsim.PacketColumns()
+            try:
+                fwsim.parse_packet_bytes(line, last, name, columns)
+            except Warning as e:
+                out.append(f"Simulator error: {e}")
+                continue
+            out.extend(fwsim.format_result(result)
+                       for result in fwsim.classify_columns(matcher, columns, cache))
+    return "".join(line + "\n" for line in out).encode("ascii"), last + 1
+
+
+def line_end(data) -> int:
+    '''length of the whole lines in data; a final '\\r' may be half of a '\\r\\n' '''
+    return max(data.rfind(b"\n"), data.rfind(b"\r", 0, len(data) - 1)) + 1
+
+
+def serve_stream(server, read, write, name):
+    """
+    Answers packet lines from read(size) with write(bytes) until read()
+    returns nothing. Every read is one batch with one write, taken against
+    the matcher current when the batch starts.
+    """
+    cache = fwsim.DecisionCache()
+    pending = b""
+    line = 1
+    while True:
+        data = read(READ_SIZE)
+        if not data:
+            break
+        data = pending + data
+        end = line_end(data)
+        data, pending = data[:end], data[end:]
+        if data:
+            out, line = answer(server.matcher, data, line, name, cache)
+            if out:
+                write(out)
+    if pending:
+        out, line = answer(server.matcher, pending, line, name, cache)
+        if out:
+            write(out)
+
+
+class PacketHandler(socketserver.BaseRequestHandler):
+    '''one connection, answered until the client closes its side'''
+
+    def handle(self):
+        serve_stream(self.server.rules, self.request.recv, self.request.sendall,
+                     self.server.server_address)
+
+
+class PacketServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_fname, rules):
+        self.rules = rules
+        super().__init__(socket_fname, PacketHandler)
+
+
+def parse_args():
+    '''parse command lines'''
+    parser = argparse.ArgumentParser(
+        prog='fwsimd',
+        description='firewall simulator daemon, answers packet lines with fw.py results',
+    )
+    parser.add_argument('rulesfname', help='filename with firewall rules')
+    parser.add_argument('--socket', metavar='PATH',
+                        help='listen on this Unix domain socket instead of reading stdin')
+    parser.add_argument('--engine', choices=fwsim.ENGINES,
+                        help=f'rule matching engine (default: $FWSIM_ENGINE or {fwsim.DEFAULT_ENGINE})')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between checks of the rules file, 0 to never reload '
+                             '(default: 1)')
+    return parser.parse_args()
+
+
+def write_stdout(data):
+    sys.stdout.buffer.write(data)
+    sys.stdout.buffer.flush()
+
+
+def main():
+    '''entry point'''
+    args = parse_args()
+    try:
+        rules = RuleServer(args.rulesfname, args.engine, args.interval)
+        if args.interval > 0:
+            threading.Thread(target=rules.watch, daemon=True).start()
+
+        if args.socket is None:
+            serve_stream(rules, lambda size: os.read(sys.stdin.fileno(), size),
+                         write_stdout, "<stdin>")
+            return
+
+        # a socket left behind by an earlier run, anything else stays
+        if os.path.lexists(args.socket):
+            if not stat.S_ISSOCK(os.lstat(args.socket).st_mode):
+                raise Warning(f"{args.socket} exists and is not a socket")
+            os.unlink(args.socket)
+        # so the socket file gets removed on a plain kill as well
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        with PacketServer(args.socket, rules) as server:
+            try:
+                server.serve_forever()
+            finally:
+                os.unlink(args.socket)
+    except BrokenPipeError:
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    except (IOError, FileNotFoundError) as e:
+        print(f"Simulator error: Error opening file: {str(e)}")
+    except Warning as e:
+        print(f"Simulator error: {e}")
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
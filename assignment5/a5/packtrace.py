@@ -0,0 +1,36 @@
+#!/bin/env python3
+# Converts a text packets file into the binary packet trace format read by
+# fwsim, so archived captures don't have to be parsed again for every run.
+
+import argparse
+
+import fwsim
+
+
+def parse_args():
+    '''parse command lines'''
+    parser = argparse.ArgumentParser(
+        prog='packtrace',
+        description='convert a packets file into a binary packet trace',
+    )
+    parser.add_argument('packetsfname', help='filename with packets')
+    parser.add_argument('tracefname', help='binary packet trace to write')
+    return parser.parse_args()
+
+
+def main():
+    '''entry point'''
+    args = parse_args()
+    try:
+        count = fwsim.pack_packets(args.packetsfname, args.tracefname)
+    except Warning as e:
+        print(f"Packing error: {e}")
+        return
+    except (IOError, FileNotFoundError) as e:
+        print(f"Packing error: Error opening file: {str(e)}")
+        return
+    print(f"{count} packets written to {args.tracefname}")
+
+
+if __name__ == "__main__":
+    main()